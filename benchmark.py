@@ -0,0 +1,564 @@
+####################
+# This file measures the performance of individual components of our pipeline.
+# Every benchmark is a sub-command, run `python benchmark.py <benchmark> --help` for its options.
+
+
+#---------- imports ----------#
+
+
+import os
+import sys
+import PIL.Image
+import glob
+import time
+import argparse
+import tempfile
+import numpy as np
+
+
+#---------- constants ----------#
+
+
+VALID_EXTENSIONS = ['jpg', 'png', 'JPG']
+
+
+#----------configuration arguments ----------#
+
+
+parser = argparse.ArgumentParser(description='measure the performance of components of our pipeline')
+subparsers = parser.add_subparsers(dest='benchmark')
+
+# options shared by several benchmarks. parents share their actions, so the
+# image options are created per benchmark to give each its own default count
+def imagesOptions(numImages=16):
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument('--input', type=str, default='input',
+                         help='directory with the images measured')
+    options.add_argument('--num_images', type=int, default=numImages,
+                         help='number of images measured, inputs are repeated if needed')
+    return options
+
+
+gifOptions = argparse.ArgumentParser(add_help=False)
+gifOptions.add_argument('--gif', type=str, required=True,
+                        help='gif whose frames are measured')
+gifOptions.add_argument('--num_frames', type=int, default=100,
+                        help='number of frames measured, frames are repeated if needed')
+
+resizeOptions = argparse.ArgumentParser(add_help=False)
+resizeOptions.add_argument('--max_resized_height', type=int, default=300,
+                           help='height the inputs are resized to, as in driver.py')
+
+styleOptions = argparse.ArgumentParser(add_help=False)
+styleOptions.add_argument('--style', type=str, default='shinkai',
+                          help='cartoon style whose model is measured')
+
+profileOptions = argparse.ArgumentParser(add_help=False)
+profileOptions.add_argument('--profile', type=str, default='square', choices=['square', 'native', 'bucketed'],
+                            help='molding profile of the detector, as in driver.py')
+
+iouOptions = argparse.ArgumentParser(add_help=False)
+iouOptions.add_argument('--iou', type=float, default=0.5,
+                        help='min IoU of two boxes of the same class to count as the same object')
+
+cartoonBatchParser = subparsers.add_parser('cartoon_batch', parents=[imagesOptions(32), resizeOptions, styleOptions],
+                                           help='CartoonGAN throughput of still images for several batch sizes')
+cartoonBatchParser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 2, 4, 8, 16],
+                                help='batch sizes to measure')
+cartoonBatchParser.add_argument('--bucket', type=int, default=0,
+                                help='pad images to multiples of this size, see `--cartoon_bucket` of driver.py')
+
+cartoonTraceParser = subparsers.add_parser('cartoon_trace', parents=[imagesOptions(20), styleOptions],
+                                           help='CartoonGAN latency and traces for images of many sizes, called '
+                                                'eagerly and through traced functions per size bucket')
+cartoonTraceParser.add_argument('--buckets', nargs='+', type=int, default=[32, 64, 128],
+                                help='size buckets to measure, see `--trace_bucket` of driver.py')
+cartoonTraceParser.add_argument('--heights', nargs='+', type=int, default=[240, 250, 270, 290, 300],
+                                help='heights the images are resized to in turn, so that sizes vary')
+
+subparsers.add_parser('detect_boxes', parents=[imagesOptions(), resizeOptions],
+                      help='Mask R-CNN latency per image with and without the mask head')
+
+detectProfileParser = subparsers.add_parser('detect_profile', parents=[imagesOptions(), resizeOptions, iouOptions],
+                                            help='Mask R-CNN latency and agreement with `square` for every molding profile')
+detectProfileParser.add_argument('--profiles', nargs='+', default=['square', 'native', 'bucketed'],
+                                 help='molding profiles to measure, the first one is the reference')
+
+detectFormatParser = subparsers.add_parser('detect_format', parents=[imagesOptions(), resizeOptions],
+                                           help='size and load time of detection results per file format, '
+                                                'the images stand in for the frames of one input')
+detectFormatParser.add_argument('--repeat', type=int, default=10,
+                                help='number of times every format is loaded')
+
+subparsers.add_parser('enhance_edges', parents=[gifOptions, resizeOptions],
+                      help='edge enhancement of every method, method by method or frame by frame. the frames of '
+                           'the gif stand in for its cartoons')
+
+detectKeyframesParser = subparsers.add_parser('detect_keyframes', parents=[gifOptions, resizeOptions, iouOptions],
+                                              help='detector calls, time and box agreement of keyframe detection '
+                                                   'against detecting every frame of a gif')
+detectKeyframesParser.add_argument('--intervals', nargs='+', type=int, default=[2, 5, 10],
+                                   help='keyframe intervals to measure')
+detectKeyframesParser.add_argument('--scene_threshold', type=float, default=30,
+                                   help='frame difference that forces a keyframe, as in driver.py')
+
+detectBatchParser = subparsers.add_parser('detect_batch', parents=[imagesOptions(32), resizeOptions, profileOptions],
+                                          help='Mask R-CNN throughput for every batch size')
+detectBatchParser.add_argument('--gif', type=str, default=None,
+                               help='gif whose frames are detected, instead of the images of `input`')
+detectBatchParser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 2, 4, 8],
+                               help='batch sizes to measure')
+
+subparsers.add_parser('detect_serving', parents=[imagesOptions(), resizeOptions, profileOptions],
+                      help='Mask R-CNN latency per image through keras `predict` and through the serving function')
+
+gifEncodeParser = subparsers.add_parser('gif_encode', parents=[gifOptions, resizeOptions],
+                                        help='encode time and size of gifs with a palette per frame against one '
+                                             'global palette')
+gifEncodeParser.add_argument('--workers', nargs='+', type=int, default=[1, 4],
+                             help='quantization threads to measure with a global palette')
+
+poolWorkersParser = subparsers.add_parser('pool_workers', parents=[styleOptions],
+                                          help='wall time of driver.py on a directory with every number of worker '
+                                               'processes, against a run with a single worker')
+poolWorkersParser.add_argument('--input', type=str, default='input',
+                               help='directory with the images transformed')
+poolWorkersParser.add_argument('--workers', nargs='+', type=int, default=[2, 4],
+                               help='numbers of worker processes to measure, a single worker is always measured')
+
+args = parser.parse_args()
+
+
+#---------- functions ----------#
+
+
+# decode and resize the images of a directory like the pipeline does, repeating them up to `count`
+def loadImages( inputDir, maxHeight, count ):
+    paths = []
+    for ext in VALID_EXTENSIONS:
+        paths.extend( glob.glob( os.path.join( inputDir, f'*.{ext}' ) ) )
+    if not paths:
+        print( f'No images found in `{inputDir}`' )
+        sys.exit( 1 )
+
+    images = []
+    for path in sorted( paths ):
+        image = PIL.Image.open( path ).convert( 'RGB' )
+        width, height = image.size
+        resizedHeight = min( height, maxHeight )
+        image = image.resize( ( int( resizedHeight * width / height ), resizedHeight ) )
+        images.append( np.asarray( image ) )
+
+    return [ images[i % len( images )] for i in range( count ) ]
+
+
+# decode and resize the frames of a gif, repeating them up to `count`
+def loadFrames( path, maxHeight, count ):
+    frames = []
+    with PIL.Image.open( path ) as gif:
+        for i in range( getattr( gif, 'n_frames', 1 ) ):
+            gif.seek( i )
+            frame = gif.convert( 'RGB' )
+            width, height = frame.size
+            resizedHeight = min( height, maxHeight )
+            frames.append( np.asarray( frame.resize( ( int( resizedHeight * width / height ), resizedHeight ) ) ) )
+
+    return [ frames[i % len( frames )] for i in range( count ) ]
+
+
+# inputs of a benchmark, the frames of `--gif` if it is given, otherwise the images of `--input`
+def loadInputs():
+    if getattr( args, 'gif', None ):
+        return loadFrames( args.gif, args.max_resized_height, getattr( args, 'num_frames', None ) or args.num_images )
+    return loadImages( args.input, args.max_resized_height, args.num_images )
+
+
+# print a table with a header row
+def printTable( header, rows ):
+    widths = [ max( len( str( c ) ) for c in column ) for column in zip( header, *rows ) ]
+    line = '  '.join( f'{{:>{w}}}' for w in widths )
+    print( line.format( *header ) )
+    print( '-' * ( sum( widths ) + 2 * ( len( widths ) - 1 ) ) )
+    for row in rows:
+        print( line.format( *row ) )
+    return
+
+
+# result and seconds of one call of `fn`. `warmup` is called first without being timed,
+# so that models are built and TensorFlow is set up before measuring
+def timed( fn, warmup = None ):
+    if warmup is not None:
+        warmup()
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+# median and 90th percentile milliseconds of calling `fn` on every item
+def latency( fn, items ):
+    latencies = []
+    for item in items:
+        start = time.perf_counter()
+        fn( item )
+        latencies.append( 1000 * ( time.perf_counter() - start ) )
+    return f'{np.median( latencies ):.1f}', f'{np.percentile( latencies, 90 ):.1f}'
+
+
+# F1 score of matching the boxes of `result` to those of `reference`, and the mean IoU of the matches
+def boxAgreement( reference, result, minIoU ):
+    from mrcnn.utils import compute_overlaps
+
+    n, m = len( reference['rois'] ), len( result['rois'] )
+    if n == 0 or m == 0:
+        return float( n == m ), []
+
+    overlaps = compute_overlaps( np.asarray( reference['rois'], np.float32 ), np.asarray( result['rois'], np.float32 ) )
+    overlaps[ np.asarray( reference['class_ids'] )[:, None] != np.asarray( result['class_ids'] )[None, :] ] = 0
+
+    # greedily match the best overlapping pairs
+    matches = []
+    while overlaps.size and overlaps.max() >= minIoU:
+        i, j = np.unravel_index( np.argmax( overlaps ), overlaps.shape )
+        matches.append( overlaps[i, j] )
+        overlaps[i, :] = 0
+        overlaps[:, j] = 0
+
+    return 2 * len( matches ) / ( n + m ), matches
+
+
+# mean box F1 and IoU of results against their references
+def agreement( references, results ):
+    scores, ious = [], []
+    for r, res in zip( references, results ):
+        score, matches = boxAgreement( r, res, args.iou )
+        scores.append( score )
+        ious.extend( matches )
+    return f'{np.mean( scores ):.3f}', f'{np.mean( ious ) if ious else 0:.3f}'
+
+
+# total size in bytes of the files in a directory
+def directorySize( path ):
+    return sum( os.path.getsize( os.path.join( path, f ) ) for f in os.listdir( path ) )
+
+
+# CartoonGAN images/second for every batch size
+def cartoonBatch():
+    import cartoonize
+
+    images = loadInputs()
+    shapes = len( set( cartoonize.bucket_shape( i.shape[:2], args.bucket ) for i in images ) )
+    print( f'{len(images)} images in {shapes} shape groups, style `{args.style}`, bucket {args.bucket}' )
+
+    model = cartoonize.get_model( args.style )
+    cartoonize.args.batch_size = 1
+    cartoonize.transform_images( images[:1], model, bucket = args.bucket )
+
+    rows = []
+    for batchSize in args.batch_sizes:
+        cartoonize.args.batch_size = batchSize
+        _, elapsed = timed( lambda: cartoonize.transform_images( images, model, bucket = args.bucket ) )
+        rows.append( ( batchSize, f'{elapsed:.2f}', f'{len(images) / elapsed:.2f}' ) )
+
+    printTable( ( 'batch size', 'seconds', 'images/s' ), rows )
+    return
+
+
+# first pass and steady state latency of single images of varying sizes, called
+# eagerly and through traced functions of every bucket
+def cartoonTrace():
+    import cartoonize
+
+    images = []
+    for i, image in enumerate( loadImages( args.input, max( args.heights ), args.num_images ) ):
+        height = args.heights[i % len( args.heights )]
+        width = int( height * image.shape[1] / image.shape[0] )
+        images.append( np.asarray( PIL.Image.fromarray( image ).resize( ( width, height ) ) ) )
+    print( f'{len(images)} images of {len( set( i.shape for i in images ) )} sizes, style `{args.style}`' )
+
+    model = cartoonize.get_model( args.style )
+    cartoonize.args.batch_size = 1
+    cartoonize.args.tile_size = 0
+
+    def transform( image ):
+        return cartoonize.transform_images( [ image ], model )
+
+    rows = []
+    for bucket in [ 0 ] + args.buckets:
+        cartoonize.args.trace_bucket = bucket
+        traces = cartoonize.TRACE_STATS['traces']
+        _, first = timed( lambda: [ transform( image ) for image in images ] )
+        rows.append( ( f'bucket {bucket}' if bucket else 'eager', cartoonize.TRACE_STATS['traces'] - traces,
+                       f'{first:.2f}', *latency( transform, images ) ) )
+
+    printTable( ( 'mode', 'traces', 'first pass s', 'median ms', 'p90 ms' ), rows )
+    return
+
+
+# Mask R-CNN milliseconds per image with masks and with boxes only
+def detectBoxes():
+    import detect
+
+    images = loadInputs()
+    print( f'{len(images)} images' )
+
+    rows = []
+    for name, masks in ( ( 'masks', True ), ( 'boxes only', False ) ):
+        model = detect.getModel( detect.makeConfig( masks = masks ) )
+        results, elapsed = timed( lambda: detect.detectImages( images, model ),
+                                  lambda: detect.detectImages( images[:1], model ) )
+        objects = sum( len( r['scores'] ) for r in results )
+        rows.append( [ name, f'{1000 * elapsed / len(images):.1f}', objects ] )
+
+    base = float( rows[0][1] )
+    for row in rows:
+        row.append( f'{base / max( float( row[1] ), 1e-9 ):.2f}x' )
+    printTable( ( 'mode', 'ms/image', 'objects', 'speedup' ), rows )
+    return
+
+
+# Mask R-CNN milliseconds per image and agreement with the first profile
+def detectProfile():
+    import detect
+
+    images = loadInputs()
+    print( f'{len(images)} images, reference profile `{args.profiles[0]}`' )
+
+    rows = []
+    reference = None
+    for profile in args.profiles:
+        model = detect.getModel( detect.makeConfig( profile = profile ) )
+        results, elapsed = timed( lambda: detect.detectImages( images, model ),
+                                  lambda: detect.detectImages( images[:1], model ) )
+        pixels = np.mean( [ np.prod( model.mold_inputs( [ im ] )[0].shape[1:3] ) for im in images ] )
+        if reference is None:
+            reference = results
+        rows.append( ( profile, f'{pixels / 1e6:.2f}', f'{1000 * elapsed / len(images):.1f}',
+                       *agreement( reference, results ) ) )
+
+    printTable( ( 'profile', 'molded MP', 'ms/image', 'box F1', 'mean IoU' ), rows )
+    return
+
+
+# bytes and load time of pickled per-frame `.npy` files against a single detection file
+def detectFormat():
+    import detect
+    from detections import ObjectsWriter
+    from detections import loadObjects
+
+    images = loadInputs()
+    results = detect.detectImages( images, detect.getModel() )
+    print( f'{len(images)} frames with {sum( len( r["scores"] ) for r in results )} objects' )
+
+    def loadPickled( path ):
+        paths = sorted( glob.glob( os.path.join( path, '*.npy' ) ) )
+        return [ np.load( p, allow_pickle = True )[()] for p in paths ]
+
+    def loadDetections( path, masks ):
+        return lambda _: loadObjects( os.path.join( path, 'objects.det' ), masks = masks )
+
+    rows = []
+    with tempfile.TemporaryDirectory() as root:
+        # previous format, one pickled dict with full size masks per frame
+        pickledDir = os.path.join( root, 'pickled' )
+        os.makedirs( pickledDir )
+        for i, r in enumerate( results ):
+            np.save( os.path.join( pickledDir, f'{i:06d}.npy' ), dict( r, masks = np.asarray( r['masks'] ) ) )
+
+        formats = [ ( 'pickled .npy', pickledDir, loadPickled ) ]
+        for name, masks in ( ( 'objects.det', False ), ( 'objects.det + rle', True ) ):
+            path = os.path.join( root, name.replace( ' + ', '_' ) )
+            os.makedirs( path )
+            with ObjectsWriter( os.path.join( path, 'objects.det' ), masks = masks ) as writer:
+                for r in results:
+                    writer.append( r )
+            formats.append( ( name, path, loadDetections( path, masks ) ) )
+
+        for name, path, load in formats:
+            _, elapsed = timed( lambda: [ load( path ) for _ in range( args.repeat ) ] )
+            rows.append( ( name, f'{directorySize( path ) / 1024:.1f}', f'{1000 * elapsed / args.repeat:.2f}' ) )
+
+    printTable( ( 'format', 'KiB', 'load ms' ), rows )
+    return
+
+
+# keyframe detection with several intervals against detecting every frame
+def detectKeyframes():
+    import detect
+
+    with PIL.Image.open( args.gif ) as gif:
+        count = min( getattr( gif, 'n_frames', 1 ), args.num_frames )
+    frames = loadFrames( args.gif, args.max_resized_height, count )
+    model = detect.getModel( detect.makeConfig( masks = False ) )
+
+    reference, elapsed = timed( lambda: detect.detectImages( frames, model ),
+                                lambda: detect.detectImages( frames[:1], model ) )
+    rows = [ ( 'every frame', len( frames ), f'{elapsed:.2f}', '1.000', '1.000' ) ]
+
+    for interval in args.intervals:
+        ( results, keyframes ), elapsed = timed(
+            lambda: detect.detectKeyframes( frames, model, interval, args.scene_threshold ) )
+        rows.append( ( f'interval {interval}', len( keyframes ), f'{elapsed:.2f}', *agreement( reference, results ) ) )
+
+    print( f'{len(frames)} frames of {args.gif}' )
+    printTable( ( 'mode', 'detector calls', 'seconds', 'box F1', 'mean IoU' ), rows )
+    return
+
+
+# every edge method on the frames of a gif, reading each frame once per method
+# like `enhance.main` did, against a single pass over the frames
+def enhanceEdges():
+    import cv2
+    import detect
+    import enhance
+
+    frames = loadInputs()
+    objects = detect.detectImages( frames, detect.getModel( detect.makeConfig( masks = False ) ) )
+    print( f'{len(frames)} frames with {sum( len( o["scores"] ) for o in objects )} objects, edges {enhance.EDGES}' )
+
+    def methodMajor():
+        for e in enhance.EDGES:
+            for path, obj in zip( paths, objects ):
+                enhance.getEdge( obj, cv2.imread( path ), e )
+
+    def frameMajor():
+        for path, obj in zip( paths, objects ):
+            frame = enhance.FrameEdges( obj, cv2.imread( path ) )
+            for e in enhance.EDGES:
+                frame.enhance( e )
+
+    with tempfile.TemporaryDirectory() as root:
+        paths = []
+        for i, frame in enumerate( frames ):
+            paths.append( os.path.join( root, f'{i}.png' ) )
+            cv2.imwrite( paths[-1], frame[:, :, ::-1] )
+
+        _, methodSeconds = timed( methodMajor )
+        _, frameSeconds = timed( frameMajor )
+
+    rows = [ ( name, f'{elapsed:.2f}', f'{len(frames) / elapsed:.1f}', f'{methodSeconds / elapsed:.2f}x' )
+             for name, elapsed in ( ( 'method by method', methodSeconds ), ( 'frame by frame', frameSeconds ) ) ]
+    printTable( ( 'order', 'seconds', 'frames/s', 'speedup' ), rows )
+    return
+
+
+# images per second of Mask R-CNN with every batch size, on gif frames which share
+# one shape or on a directory of images
+def detectBatch():
+    import detect
+
+    images = loadInputs()
+    print( f'{len(images)} images, profile `{args.profile}`' )
+
+    rows = []
+    for batchSize in args.batch_sizes:
+        model = detect.getModel( detect.makeConfig( profile = args.profile, batchSize = batchSize ) )
+        batches = len( detect.detectionBatches( images, model.config ) )
+        # the first pass also builds the models of smaller last batches
+        _, elapsed = timed( lambda: detect.detectImages( images, model ),
+                            lambda: detect.detectImages( images, model ) )
+        rows.append( ( batchSize, batches, f'{elapsed:.2f}', f'{len(images) / elapsed:.2f}' ) )
+
+    printTable( ( 'batch size', 'forward passes', 'seconds', 'images/s' ), rows )
+    return
+
+
+# latency of single images through `predict` and through the serving function
+# of the same model, after a first pass which traces the function of every molded shape
+def detectServing():
+    import detect
+
+    images = loadInputs()
+    model = detect.getModel( detect.makeConfig( profile = args.profile ) )
+    print( f'{len(images)} images, profile `{args.profile}`, batch size 1' )
+
+    rows = []
+    for serving in ( False, True ):
+        # both paths run the same weights, only the way the graph is called differs
+        model.config.DETECTION_SERVING = serving
+        _, first = timed( lambda: detect.detectImages( images, model ) )
+        rows.append( ( 'serving' if serving else 'predict', f'{first:.2f}',
+                       *latency( lambda im: model.detect( [ im ] ), images ) ) )
+
+    model.config.DETECTION_SERVING = False
+    printTable( ( 'path', 'first pass s', 'median ms', 'p90 ms' ), rows )
+    return
+
+
+# encode the same frames with imageio's writer, one palette per frame,
+# and with a global palette quantized on threads
+def gifEncode():
+    import encoder
+
+    frames = loadInputs()
+    modes = [ ( 'frame', 1 ) ] + [ ( 'global', workers ) for workers in args.workers ]
+
+    def encode( path, palette, workers ):
+        with encoder.FrameEncoder( path, gifPalette = palette, workers = workers ) as output:
+            for frame in frames:
+                output.append( frame )
+
+    rows = []
+    with tempfile.TemporaryDirectory() as root:
+        for palette, workers in modes:
+            path = os.path.join( root, f'{palette}-{workers}.gif' )
+            _, elapsed = timed( lambda: encode( path, palette, workers ) )
+            rows.append( ( palette, workers, f'{elapsed:.2f}', f'{os.path.getsize( path ) / 1024:.0f}' ) )
+
+    print( f'{len(frames)} frames of {args.gif}' )
+    printTable( ( 'palette', 'workers', 'seconds', 'KB' ), rows )
+    return
+
+
+# end to end runs of driver.py with the process pool. every run includes starting the
+# workers and loading their models, so the inputs should take much longer than that
+def poolWorkers():
+    import subprocess
+
+    count = sum( len( glob.glob( os.path.join( args.input, f'*.{ext}' ) ) ) for ext in VALID_EXTENSIONS )
+    driver = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'driver.py' )
+    print( f'{count} images of {args.input}, style `{args.style}`' )
+
+    rows = []
+    for workers in sorted( set( [ 1 ] + args.workers ) ):
+        with tempfile.TemporaryDirectory() as root:
+            command = [ sys.executable, driver, '--input', args.input, '--output_dir', root, '--styles', args.style,
+                        '--num_workers', str( workers ), '--no_cache', '--no_manifest', '--skip_comparison' ]
+            _, elapsed = timed( lambda: subprocess.run( command, check = True, stdout = subprocess.DEVNULL ) )
+        rows.append( [ workers, f'{elapsed:.2f}', f'{count / elapsed:.2f}' ] )
+
+    base = float( rows[0][1] )
+    for row in rows:
+        row.append( f'{base / max( float( row[1] ), 1e-9 ):.2f}x' )
+    printTable( ( 'workers', 'seconds', 'images/s', 'speedup' ), rows )
+    return
+
+
+#---------- main execution ----------#
+
+
+BENCHMARKS = {
+    'cartoon_batch': cartoonBatch,
+    'cartoon_trace': cartoonTrace,
+    'detect_boxes': detectBoxes,
+    'detect_profile': detectProfile,
+    'detect_format': detectFormat,
+    'enhance_edges': enhanceEdges,
+    'detect_keyframes': detectKeyframes,
+    'detect_batch': detectBatch,
+    'detect_serving': detectServing,
+    'gif_encode': gifEncode,
+    'pool_workers': poolWorkers,
+}
+
+
+def main():
+    if args.benchmark not in BENCHMARKS:
+        parser.print_help()
+        return
+
+    BENCHMARKS[args.benchmark]()
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+####################
+# This file implements a content-addressed cache for intermediate results.
+# Entries are keyed on the bytes of the input and on every parameter that changes
+# a result, so a renamed input is still found and a modified input is recomputed.
+
+
+import os
+import sys
+import hashlib
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+# kinds of results that are cached separately
+KINDS = ['objects', 'cartoons', 'enhanced']
+
+
+# logger
+logger = logging.getLogger("Cache")
+logger.propagate = False
+log_lvl = {"debug": logging.DEBUG, "info": logging.INFO,
+           "warning": logging.WARNING, "error": logging.ERROR,
+           "critical": logging.CRITICAL}
+logger.setLevel( log_lvl['info'] )
+formatter = logging.Formatter(
+    "[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s", "%Y-%m-%d %H:%M:%S")
+stdhandler = logging.StreamHandler(sys.stdout)
+stdhandler.setFormatter(formatter)
+logger.addHandler(stdhandler)
+
+
+# hash every part into a hexadecimal key
+def makeKey( *parts ):
+    h = hashlib.sha1()
+    for p in parts:
+        if not isinstance( p, bytes ):
+            p = str( p ).encode( 'utf-8' )
+        h.update( len( p ).to_bytes( 8, 'little' ) )
+        h.update( p )
+    return h.hexdigest()
+
+
+# key of an input file together with the preprocessing applied to it.
+# the file is hashed block by block, so videos are never read into memory at once
+def inputKey( path, args ):
+    content = hashlib.sha1()
+    with open( path, 'rb' ) as f:
+        for block in iter( lambda: f.read( 1 << 20 ), b'' ):
+            content.update( block )
+    return makeKey( content.digest(), args.keep_original_size, args.max_resized_height,
+                    args.gif_frame_frequency, args.max_num_frames, args.dedup, args.dedup_distance )
+
+
+# flatten per-frame detection results into a few fixed-dtype arrays
+def packObjects( objects ):
+    counts = np.array( [ len( o['scores'] ) for o in objects ], np.int32 )
+    rois = [ np.asarray( o['rois'], np.int32 ).reshape( -1, 4 ) for o in objects ]
+    classIds = [ np.asarray( o['class_ids'], np.int32 ) for o in objects ]
+    scores = [ np.asarray( o['scores'], np.float32 ) for o in objects ]
+    return {
+        'counts': counts,
+        'rois': np.concatenate( rois ) if rois else np.zeros( ( 0, 4 ), np.int32 ),
+        'class_ids': np.concatenate( classIds ) if classIds else np.zeros( 0, np.int32 ),
+        'scores': np.concatenate( scores ) if scores else np.zeros( 0, np.float32 ),
+    }
+
+
+# inverse of `packObjects`, masks are not cached
+def unpackObjects( arrays ):
+    objects = []
+    offsets = np.concatenate( [ [ 0 ], np.cumsum( arrays['counts'] ) ] )
+    for start, end in zip( offsets[:-1], offsets[1:] ):
+        objects.append( {
+            'rois': arrays['rois'][start:end],
+            'class_ids': arrays['class_ids'][start:end],
+            'scores': arrays['scores'][start:end],
+        } )
+    return objects
+
+
+# stores detections, cartoons and enhanced frames under the hash of what produced them.
+# once the entries exceed `budgetMb`, the least recently used ones are removed
+class ResultCache( object ):
+    def __init__( self, root, budgetMb = 2048 ):
+        self.root = root
+        self.budget = budgetMb * 1024 ** 2
+        self.lock = threading.Lock()
+        self.hits = { k: 0 for k in KINDS }
+        self.misses = { k: 0 for k in KINDS }
+        self.evictions = 0
+        self.entries = self.scan()
+        self.total = sum( self.entries.values() )
+
+
+    def path( self, kind, key ):
+        return os.path.join( self.root, kind, key[:2], f'{key}.npz' )
+
+
+    # size of every existing entry, least recently used first
+    def scan( self ):
+        entries = []
+        for kind in KINDS:
+            for dirPath, _, files in os.walk( os.path.join( self.root, kind ) ):
+                for f in files:
+                    if not f.endswith( '.npz' ):
+                        continue
+                    path = os.path.join( dirPath, f )
+                    try:
+                        stat = os.stat( path )
+                    except OSError:
+                        continue
+                    entries.append( ( stat.st_mtime, path, stat.st_size ) )
+        return OrderedDict( ( path, size ) for _, path, size in sorted( entries ) )
+
+
+    # return the cached arrays, or None if the entry does not exist
+    def load( self, kind, key ):
+        path = self.path( kind, key )
+        try:
+            with np.load( path ) as data:
+                arrays = { name: data[name] for name in data.files }
+            # the modification time orders entries by last use across runs
+            os.utime( path )
+        except ( OSError, ValueError ):
+            arrays = None
+
+        with self.lock:
+            if arrays is None:
+                self.misses[kind] += 1
+            else:
+                self.hits[kind] += 1
+                if path in self.entries:
+                    self.entries.move_to_end( path )
+        logger.debug( f"{'Hit' if arrays is not None else 'Miss'} for {kind} {key}" )
+        return arrays
+
+
+    # write an entry atomically, so readers never see a partial file
+    def save( self, kind, key, arrays ):
+        path = self.path( kind, key )
+        saveDir = os.path.dirname( path )
+        if not os.path.exists( saveDir ):
+            os.makedirs( saveDir, exist_ok = True )
+
+        tmpPath = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open( tmpPath, 'wb' ) as f:
+            np.savez_compressed( f, **arrays )
+        os.replace( tmpPath, path )
+
+        with self.lock:
+            self.total += os.path.getsize( path ) - self.entries.get( path, 0 )
+            self.entries[path] = os.path.getsize( path )
+            self.entries.move_to_end( path )
+            self.evict()
+        return path
+
+
+    # remove least recently used entries until the cache fits its budget.
+    # the entry written last is always kept
+    def evict( self ):
+        while len( self.entries ) > 1 and self.total > self.budget:
+            path, size = self.entries.popitem( last = False )
+            self.total -= size
+            self.evictions += 1
+            try:
+                os.remove( path )
+            except OSError:
+                pass
+            logger.debug( f"Evicted {path}" )
+
+
+    # read the entries again, after other processes wrote to the cache, and evict
+    # down to the budget
+    def reload( self ):
+        with self.lock:
+            self.entries = self.scan()
+            self.total = sum( self.entries.values() )
+            self.evict()
+
+
+    def residentBytes( self ):
+        return self.total
+
+
+    def stats( self ):
+        return { k: ( self.hits[k], self.misses[k] ) for k in KINDS }
@@ -1,6 +1,9 @@
 import os
+import threading
 import numpy as np
 import tensorflow as tf
+from contextlib import contextmanager
+from collections import OrderedDict
 # from keras_contrib.layers import InstanceNormalization
 # from keras_contrib.layers.normalization.instancenormalization import InstanceNormalization
 from tensorflow.keras.layers import Layer, InputSpec
@@ -8,6 +11,29 @@ from tensorflow.keras.layers import Layer, InputSpec
 PRETRAINED_WEIGHT_DIR = os.path.join(
     os.path.dirname(os.path.realpath(__file__)), "pretrained_weights")
 
+# bump when the generator or its weights change, cached cartoons are keyed on it
+MODEL_VERSION = 1
+
+# (mode, stats) of `instance_norm_stats` in the current thread
+_norm_stats = threading.local()
+
+
+@contextmanager
+def instance_norm_stats(mode, stats):
+    """Within the block, instance normalization layers called from this thread
+    either record their mean and deviation into `stats` ("record"), or use the
+    recorded ones instead of computing them ("fixed"). Entries are keyed on the
+    layer name, so both passes have to use the same model.
+    Recording on a downscaled image and reusing the statistics for its tiles keeps
+    the tiles consistent with each other.
+    """
+    previous = getattr(_norm_stats, "state", None)
+    _norm_stats.state = (mode, stats)
+    try:
+        yield stats
+    finally:
+        _norm_stats.state = previous
+
 
 class InstanceNormalization(Layer):
     """Instance normalization layer.
@@ -115,8 +141,14 @@ class InstanceNormalization(Layer):
 
         del reduction_axes[0]
 
-        mean = tf.keras.backend.mean(inputs, reduction_axes, keepdims=True)
-        stddev = tf.keras.backend.std(inputs, reduction_axes, keepdims=True) + self.epsilon
+        mode, stats = getattr(_norm_stats, "state", None) or (None, None)
+        if mode == "fixed":
+            mean, stddev = stats[self.name]
+        else:
+            mean = tf.keras.backend.mean(inputs, reduction_axes, keepdims=True)
+            stddev = tf.keras.backend.std(inputs, reduction_axes, keepdims=True) + self.epsilon
+            if mode == "record":
+                stats[self.name] = (mean, stddev)
         normed = (inputs - mean) / stddev
 
         broadcast_shape = [1] * len(input_shape)
@@ -287,6 +319,60 @@ def load_model(style):
     return model
 
 
+class ModelCache(object):
+    """Keeps built generators resident across images.
+    Least recently used styles are evicted once the weights of the resident
+    models exceed `budget_mb`. The most recently requested model is always
+    kept, even if it alone exceeds the budget.
+    """
+    def __init__(self, budget_mb=1024):
+        self.budget_mb = budget_mb
+        self.models = OrderedDict()
+        self.sizes = dict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def model_size(model):
+        return sum(w.shape.num_elements() * w.dtype.size for w in model.weights)
+
+    def resident_bytes(self):
+        return sum(self.sizes.values())
+
+    def get(self, style):
+        with self.lock:
+            if style in self.models:
+                self.hits += 1
+                self.models.move_to_end(style)
+                return self.models[style]
+
+            self.misses += 1
+            model = load_model(style)
+            self.models[style] = model
+            self.sizes[style] = self.model_size(model)
+            self.evict()
+            return model
+
+    def evict(self):
+        budget = self.budget_mb * 1024 ** 2
+        while len(self.models) > 1 and self.resident_bytes() > budget:
+            style, _ = self.models.popitem(last=False)
+            del self.sizes[style]
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "resident": list(self.models.keys()),
+            "resident_mb": self.resident_bytes() / 1024 ** 2,
+            "budget_mb": self.budget_mb,
+        }
+
+
 if __name__ == '__main__':
     g = load_model(style="shinkai")
     np.random.seed(9527)
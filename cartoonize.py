@@ -9,9 +9,14 @@ import glob
 import imageio
 import logging
 import argparse
+import threading
 import numpy as np
+import tensorflow as tf
+import encoder
 from tqdm import tqdm
 from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from cartoongan import cartoongan
 
 STYLES = ["shinkai", "hayao", "hosoda", "paprika"]
@@ -58,15 +63,37 @@ parser.add_argument("--max_resized_height", type=int, default=300,
                          "aspect ratio. Set higher value or enable `keep_original_size` if you want larger image.")
 parser.add_argument("--convert_gif_to_mp4", action="store_true",
                     help="convert transformed gif to mp4 which is much more smaller and easier to share. "
-                         "`ffmpeg` need to be installed at first.")
+                         "it is encoded from the same frames as the gif with `imageio-ffmpeg`.")
+parser.add_argument("--gif_palette", type=str, default="frame", choices=encoder.GIF_PALETTES,
+                    help="`frame` quantizes every frame of an output gif to its own palette. `global` shares one "
+                         "palette computed from sampled frames")
+parser.add_argument("--gif_workers", type=int, default=4,
+                    help="threads quantizing the frames of a gif when `gif_palette` is `global`")
 parser.add_argument("--logging_lvl", type=str, default="info",
                     choices=["debug", "info", "warning", "error", "critical"],
                     help="logging level which decide how verbosely the program will be. set to `debug` if necessary")
 parser.add_argument("--debug", action="store_true",
                     help="show the most detailed logging messages for debugging purpose")
+parser.add_argument("--cartoon_bucket", type=int, default=0,
+                    help="pad images up to multiples of this size so that images of different sizes can be "
+                         "cartoonized in the same batch. 0 only batches images of exactly the same size")
+parser.add_argument("--tile_size", type=int, default=0,
+                    help="cartoonize images larger than this in tiles of this size, so that memory use is bounded "
+                         "by the tile size instead of the image size. 0 always transforms whole images")
+parser.add_argument("--tile_overlap", type=int, default=32,
+                    help="pixels shared by neighboring tiles, blended to hide the seams")
+parser.add_argument("--trace_bucket", type=int, default=0,
+                    help="run CartoonGAN through one traced function per size bucket, padding inputs up to multiples "
+                         "of this size, so that new resolutions reuse a traced graph. 0 calls the model eagerly")
+parser.add_argument("--concurrent_styles", action="store_true",
+                    help="run every requested style at the same time on the shared preprocessed input")
+parser.add_argument("--model_cache_mb", type=float, default=1024,
+                    help="memory budget in MB for CartoonGAN models kept loaded between images. least recently used "
+                         "styles are unloaded when the budget is exceeded")
 parser.add_argument("--show_tf_cpp_log", action="store_true")
 
-args = parser.parse_args()
+# the driver shares its command line with this module, ignore options that only the driver knows
+args, _ = parser.parse_known_args()
 
 TEMPORARY_DIR = os.path.join(f"{args.output_dir}", ".tmp")
 
@@ -88,6 +115,9 @@ logger.addHandler(stdhandler)
 if not args.show_tf_cpp_log:
     os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
 
+# built CartoonGAN models shared by every call of `main`
+MODEL_CACHE = cartoongan.ModelCache(args.model_cache_mb)
+
 
 def handle_args( funArgs ):
     global args
@@ -101,6 +131,11 @@ def handle_args( funArgs ):
     return
 
 
+def get_model(style):
+    MODEL_CACHE.budget_mb = args.model_cache_mb
+    return MODEL_CACHE.get(style)
+
+
 def pre_processing(image_path, style, expand_dim=True):
     input_image = PIL.Image.open(image_path).convert("RGB")
 
@@ -113,7 +148,11 @@ def pre_processing(image_path, style, expand_dim=True):
             logger.debug(f"resized ({width}, {height}) to: ({resized_width}, {resized_height})")
             input_image = input_image.resize((resized_width, resized_height))
 
-    input_image = np.asarray(input_image)
+    return to_model_input(input_image, expand_dim=expand_dim)
+
+
+def to_model_input(image, expand_dim=False):
+    input_image = np.asarray(image)
     input_image = input_image.astype(np.float32)
 
     input_image = input_image[:, :, [2, 1, 0]]
@@ -148,6 +187,20 @@ def save_transformed_image(output_image, img_filename, save_dir):
 
 def save_concatenated_image(image_paths, image_folder="comparison", num_columns=2):
     images = [PIL.Image.open(i).convert('RGB') for i in image_paths]
+    images_comb = concatenate_images(images, num_columns=num_columns)
+    file_name = image_paths[0].split(os.path.sep)[-1]
+
+    if args.output_dir not in image_folder:
+        image_folder = os.path.join(args.output_dir, image_folder)
+    if not os.path.exists(image_folder):
+        os.makedirs(image_folder)
+
+    image_path = os.path.join(image_folder, file_name)
+    images_comb.save(image_path)
+    return image_path
+
+
+def concatenate_images(images, num_columns=2):
     # pick the image which is the smallest, and resize the others to match it (can be arbitrary image shape here)
     min_shape = sorted([(np.sum(i.size), i.size) for i in images])[0][1]
     array = np.asarray([np.asarray(i.resize(min_shape)) for i in images])
@@ -177,17 +230,7 @@ def save_concatenated_image(image_paths, image_folder="comparison", num_columns=
     else:
         logger.debug(f"Wrong `comparison_view`: {args.comparison_view}")
 
-    images_comb = PIL.Image.fromarray(images_comb)
-    file_name = image_paths[0].split(os.path.sep)[-1]
-
-    if args.output_dir not in image_folder:
-        image_folder = os.path.join(args.output_dir, image_folder)
-    if not os.path.exists(image_folder):
-        os.makedirs(image_folder)
-
-    image_path = os.path.join(image_folder, file_name)
-    images_comb.save(image_path)
-    return image_path
+    return PIL.Image.fromarray(images_comb)
 
 
 def convert_gif_to_png(gif_path):
@@ -203,9 +246,13 @@ def convert_gif_to_png(gif_path):
         logger.debug(f"Creating temporary folder: {png_dir} for storing intermediate result...")
         os.makedirs(png_dir)
 
+    # frames of an interrupted extraction are stale, only reuse a completed one
+    complete_marker = os.path.join(png_dir, ".complete")
     prev_generated_png_paths = glob.glob(png_dir + '/*.png')
-    if prev_generated_png_paths:
+    if prev_generated_png_paths and os.path.exists(complete_marker):
         return prev_generated_png_paths
+    for path in prev_generated_png_paths:
+        os.remove(path)
 
     num_processed_frames = 0
     logger.debug("Generating png images...")
@@ -237,11 +284,12 @@ def convert_gif_to_png(gif_path):
     except EOFError:
         pass  # end of sequence
 
+    open(complete_marker, "w").close()
     logger.debug(f"Number of {len(png_paths)} png images were generated at {png_dir}.")
     return png_paths
 
 
-def transform_png_images(image_paths, model, style, return_existing_result=False):
+def transform_png_images(image_paths, model, style, return_existing_result=False, prepared=None):
     transformed_image_paths = list()
     save_dir = os.path.join("/".join(image_paths[0].split(os.path.sep)[:-1]), style)
     logger.debug(f"Transforming {len(image_paths)} images and saving them to {save_dir}....")
@@ -249,48 +297,195 @@ def transform_png_images(image_paths, model, style, return_existing_result=False
     if return_existing_result:
         return glob.glob(os.path.join(save_dir, "*.png"))
 
-    num_batch = int(np.ceil(len(image_paths) / args.batch_size))
-    image_paths = np.array_split(image_paths, num_batch)
-
-    logger.debug(f"Processing {num_batch} batches with batch_size={args.batch_size}...")
-    for batch_image_paths in image_paths:
-        image_filenames = [path.split(os.path.sep)[-1] for path in batch_image_paths]
-        input_images = [pre_processing(path, style=style, expand_dim=False) for path in batch_image_paths]
-        input_images = np.stack(input_images, axis=0)
-        transformed_images = model(input_images)
-        output_images = [post_processing(image, style=style)
-                         for image in np.split(transformed_images, transformed_images.shape[0])]
-        paths = [save_transformed_image(img, f, save_dir)
-                 for img, f in zip(output_images, image_filenames)]
-        transformed_image_paths.extend(paths)
+    # frames prepared by the caller are shared by every style
+    if prepared is None:
+        prepared = prepare_images([np.asarray(PIL.Image.open(path).convert("RGB")) for path in image_paths])
+
+    logger.debug(f"Processing {len(prepared['batches'])} batches with batch_size={args.batch_size}...")
+    output_images = transform_prepared(prepared, model)
+    image_filenames = [path.split(os.path.sep)[-1] for path in image_paths]
+    paths = [save_transformed_image(img, f, save_dir)
+             for img, f in zip(output_images, image_filenames)]
+    transformed_image_paths.extend(paths)
 
     return transformed_image_paths
 
 
+# round (height, width) up to multiples of `bucket`, 0 keeps the shape
+def bucket_shape(shape, bucket):
+    if not bucket:
+        return tuple(shape)
+    return tuple(int(np.ceil(d / bucket)) * bucket for d in shape)
+
+
+# model input batches of same-shape images, padded to `bucket`, shared by every style
+def prepare_images(images, bucket=0):
+    groups = OrderedDict()
+    tiled = list()
+    for i, image in enumerate(images):
+        if args.tile_size and max(image.shape[:2]) > args.tile_size:
+            tiled.append((i, to_model_input(image)))
+        else:
+            groups.setdefault(bucket_shape(image.shape[:2], bucket), []).append(i)
+    logger.debug(f"Preparing {len(images)} images in {len(groups)} shape groups and {len(tiled)} tiled images...")
+
+    batches = list()
+    for (height, width), indices in groups.items():
+        for start in range(0, len(indices), args.batch_size):
+            batch = indices[start:start + args.batch_size]
+            input_images = list()
+            for i in batch:
+                input_image = to_model_input(images[i])
+                pad_height, pad_width = height - input_image.shape[0], width - input_image.shape[1]
+                if pad_height or pad_width:
+                    input_image = np.pad(input_image, ((0, pad_height), (0, pad_width), (0, 0)), mode="reflect")
+                input_images.append(input_image)
+            batches.append((batch, np.stack(input_images, axis=0)))
+
+    return {"batches": batches, "tiled": tiled, "shapes": [image.shape[:2] for image in images]}
+
+
+# run prepared batches through a model, results are uint8 RGB cropped to the inputs
+def transform_prepared(prepared, model):
+    run = traced_model(model, args.trace_bucket) if args.trace_bucket else model
+    output_images = [None] * len(prepared["shapes"])
+    for batch, input_images in prepared["batches"]:
+        transformed_images = run(input_images)
+        for i, image in zip(batch, np.split(transformed_images, transformed_images.shape[0])):
+            h, w = prepared["shapes"][i]
+            output_images[i] = post_processing(image, style=None)[:h, :w].astype(np.uint8)
+    for i, input_image in prepared.get("tiled", []):
+        output_images[i] = transform_tiled(input_image, model, args.tile_size, args.tile_overlap)
+    return output_images
+
+
+# traces and calls of every traced model
+TRACE_STATS = {"traces": 0, "calls": 0}
+TRACE_LOCK = threading.Lock()
+
+
+# runs a generator through one traced function per padded size, tiled inference stays eager
+class TracedModel(object):
+    def __init__(self, model, bucket):
+        self.model = model
+        self.bucket = bucket
+        self.functions = dict()
+
+    def function(self, height, width):
+        with TRACE_LOCK:
+            if (height, width) not in self.functions:
+                def run(input_images):
+                    # only runs while tracing
+                    TRACE_STATS["traces"] += 1
+                    logger.debug(f"Tracing CartoonGAN for inputs of ({height}, {width})...")
+                    return self.model(input_images, training=False)
+                signature = [tf.TensorSpec([None, height, width, 3], tf.float32)]
+                self.functions[(height, width)] = tf.function(run, input_signature=signature)
+            TRACE_STATS["calls"] += 1
+            return self.functions[(height, width)]
+
+    def __call__(self, input_images):
+        input_images = np.asarray(input_images, np.float32)
+        height, width = input_images.shape[1:3]
+        padded_height, padded_width = bucket_shape((height, width), self.bucket)
+        if padded_height != height or padded_width != width:
+            input_images = np.pad(input_images, ((0, 0), (0, padded_height - height), (0, padded_width - width),
+                                                 (0, 0)), mode="reflect")
+        output_images = self.function(padded_height, padded_width)(input_images)
+        return output_images.numpy()[:, :height, :width]
+
+
+# traced runner of a model, kept on the model so it is dropped when the style is evicted
+def traced_model(model, bucket):
+    with TRACE_LOCK:
+        traced = getattr(model, "traced_model", None)
+        if traced is None or traced.bucket != bucket:
+            traced = TracedModel(model, bucket)
+            model.traced_model = traced
+        return traced
+
+
+# cartoonize decoded RGB images, batched as in `prepare_images`
+def transform_images(images, model, bucket=0):
+    return transform_prepared(prepare_images(images, bucket=bucket), model)
+
+
+# offsets of tiles covering `size` with at least `overlap` shared pixels, aligned to multiples of 4
+def tile_starts(size, tile, overlap):
+    step = max(4, (tile - overlap) // 4 * 4)
+    starts = list(range(0, size - tile, step))
+    return starts + [size - tile]
+
+
+# blending weight of a tile, ramping up over `overlap` pixels from every border
+def tile_weight(height, width, overlap):
+    def ramp(n):
+        i = np.arange(n)
+        return np.minimum(np.minimum(i + 1, n - i) / (overlap + 1), 1.0)
+    return np.outer(ramp(height), ramp(width)).astype(np.float32)[:, :, None]
+
+
+# cartoonize an image in overlapping tiles, normalized with statistics of a low resolution pass
+def transform_tiled(input_image, model, tile_size, overlap=32):
+    height, width = input_image.shape[:2]
+    padded_height, padded_width = bucket_shape((height, width), 4)
+    input_image = np.pad(input_image, ((0, padded_height - height), (0, padded_width - width), (0, 0)),
+                         mode="reflect")
+
+    tile_size = max(tile_size // 4 * 4, overlap // 4 * 4 + 4)
+    tile_height, tile_width = min(tile_size, padded_height), min(tile_size, padded_width)
+
+    # global statistics from a low resolution pass
+    scale = tile_size / max(padded_height, padded_width)
+    small_shape = bucket_shape((max(1, int(padded_height * scale)), max(1, int(padded_width * scale))), 4)
+    small_image = tf.image.resize(input_image[None], small_shape, method="area")
+    stats = dict()
+    with cartoongan.instance_norm_stats("record", stats):
+        model(small_image)
+
+    tiles = [(y, x) for y in tile_starts(padded_height, tile_height, overlap)
+             for x in tile_starts(padded_width, tile_width, overlap)]
+    logger.debug(f"Transforming ({height}, {width}) in {len(tiles)} tiles of ({tile_height}, {tile_width})...")
+
+    weight = tile_weight(tile_height, tile_width, overlap)
+    output_image = np.zeros((padded_height, padded_width, 3), np.float32)
+    total_weight = np.zeros((padded_height, padded_width, 1), np.float32)
+    with cartoongan.instance_norm_stats("fixed", stats):
+        for start in range(0, len(tiles), args.batch_size):
+            batch = tiles[start:start + args.batch_size]
+            input_tiles = np.stack([input_image[y:y + tile_height, x:x + tile_width] for y, x in batch], axis=0)
+            output_tiles = model(input_tiles).numpy()
+            for (y, x), tile in zip(batch, output_tiles):
+                output_image[y:y + tile_height, x:x + tile_width] += tile * weight
+                total_weight[y:y + tile_height, x:x + tile_width] += weight
+
+    output_image /= total_weight
+    return post_processing(output_image[None], style=None)[:height, :width].astype(np.uint8)
+
+
+# combine png frames into a gif, and into an mp4 from the same frames with `convert_gif_to_mp4`
 def save_png_images_as_gif(image_paths, image_filename, style="comparison"):
     gif_dir = os.path.join(args.output_dir, style)
     if not os.path.exists(gif_dir):
         os.makedirs(gif_dir)
     gif_path = os.path.join(gif_dir, image_filename)
+    mp4_path = encoder.mp4Path(gif_path) if args.convert_gif_to_mp4 else None
 
-    with imageio.get_writer(gif_path, mode='I') as writer:
+    with encoder.FrameEncoder(gif_path, mp4_path, gifPalette=args.gif_palette, workers=args.gif_workers) as output:
         file_names = sorted(image_paths, key=lambda x: int(x.split('/')[-1].replace('.png', '')))
         logger.debug(f"Combining {len(file_names)} png images into {gif_path}...")
         for i, filename in enumerate(file_names):
             image = imageio.imread(filename)
-            writer.append_data(image)
+            output.append(image)
     return gif_path
 
 
+# encode an existing gif as mp4 in the `mp4` folder next to it
 def convert_gif_to_mp4(gif_path, crf=25):
-    mp4_dir = os.path.join(os.path.dirname(gif_path), "mp4")
-    gif_file = gif_path.split(os.path.sep)[-1]
-    if not os.path.exists(mp4_dir):
-        os.makedirs(mp4_dir)
-    mp4_path = os.path.join(mp4_dir, gif_file.replace(".gif", ".mp4"))
-    cmd = "ffmpeg -y -i {} -movflags faststart -pix_fmt yuv420p -vf \"scale=trunc(iw/2)*2:trunc(ih/2)*2\" -crf {} {}"
-    cmd = cmd.replace("My Drive", "My\ Drive")  # noqa: W605
-    os.system(cmd.format(gif_path, crf, mp4_path))
+    with encoder.FrameEncoder(mp4Path=encoder.mp4Path(gif_path), crf=crf) as output:
+        for frame in imageio.get_reader(gif_path):
+            output.append(np.asarray(PIL.Image.fromarray(frame).convert("RGB")))
+    return encoder.mp4Path(gif_path)
 
 
 def result_exist(image_path, style):
@@ -311,12 +506,12 @@ def main( image_path, funArgs = {} ):
     # get file name
     image_filename = image_path.split(os.path.sep)[-1]
 
-    # load all necessary models
+    # load all necessary models, styles used by previous images are still resident
     logger.info(f"Loading CartoonGAN model...")
     styles = args.styles
     models = list()
     for style in styles:
-        models.append(cartoongan.load_model(style))
+        models.append(get_model(style))
     logger.info(f"Cartoonizing images using {', '.join(styles)} style...")
 
     # transform gif
@@ -328,18 +523,21 @@ def main( image_path, funArgs = {} ):
         png_paths_list = [png_paths]
         num_images = len(png_paths)
 
+        # frames are read and converted once, for the first style with work left
+        prepared = None
+
         # cartoonize
         for model, style in zip(models, styles):
             return_existing_result = result_exist(image_path, style) or not args.overwrite
+            if not return_existing_result and prepared is None:
+                prepared = prepare_images([np.asarray(PIL.Image.open(path).convert("RGB")) for path in png_paths])
 
             transformed_png_paths = transform_png_images(png_paths, model, style,
-                    return_existing_result=return_existing_result)
+                    return_existing_result=return_existing_result, prepared=prepared)
             png_paths_list.append(transformed_png_paths)
 
             if not return_existing_result:
                 gif_path = save_png_images_as_gif(transformed_png_paths, image_filename, style)
-                if args.convert_gif_to_mp4:
-                    convert_gif_to_mp4(gif_path)
 
         rearrange_paths_list = [[li[i] for li in png_paths_list] for i in range(num_images)]
 
@@ -352,25 +550,35 @@ def main( image_path, funArgs = {} ):
 
         if not args.skip_comparison:
             gif_path = save_png_images_as_gif(combined_image_paths, image_filename)
-            if args.convert_gif_to_mp4:
-                convert_gif_to_mp4(gif_path)
 
     # transform image
     else:
-        related_image_paths = [image_path]
-        for model, style in zip(models, styles):
-            input_image = pre_processing(image_path, style=style)
+        # preprocess once, every style reads the same tensor
+        input_image = pre_processing(image_path, style=None)
+
+        def transform(model, style):
             save_dir = os.path.join(args.output_dir, style)
             return_existing_result = result_exist(image_path, style) and not args.overwrite
 
             if not return_existing_result:
-                transformed_image = model.predict(input_image, use_multiprocessing=True)
-                output_image = post_processing(transformed_image, style=style)
-                transformed_image_path = save_transformed_image(output_image, image_filename, save_dir)
-            else:
-                transformed_image_path = save_transformed_image(None, image_filename, save_dir)
+                if args.tile_size and max(input_image.shape[1:3]) > args.tile_size:
+                    output_image = transform_tiled(input_image[0], model, args.tile_size, args.tile_overlap)
+                elif args.trace_bucket:
+                    transformed_image = traced_model(model, args.trace_bucket)(input_image)
+                    output_image = post_processing(transformed_image, style=style)
+                else:
+                    transformed_image = model.predict(input_image, use_multiprocessing=True)
+                    output_image = post_processing(transformed_image, style=style)
+                return save_transformed_image(output_image, image_filename, save_dir)
+            return save_transformed_image(None, image_filename, save_dir)
+
+        if args.concurrent_styles and len(styles) > 1:
+            with ThreadPoolExecutor(max_workers=len(styles)) as executor:
+                transformed_image_paths = list(executor.map(transform, models, styles))
+        else:
+            transformed_image_paths = [transform(model, style) for model, style in zip(models, styles)]
 
-            related_image_paths.append(transformed_image_path)
+        related_image_paths = [image_path] + transformed_image_paths
 
         if not args.skip_comparison:
             save_concatenated_image(related_image_paths)
@@ -4,13 +4,17 @@
 
 import cv2
 import os
+import copy
 import sys
+import time
 import glob
 import logging
+import threading
 import numpy as np
 import mrcnn.config as mConfig
 import mrcnn.model as mModel
 import mrcnn.visualize as mVisualize
+from detections import ObjectsWriter
 
 # COCO class labels 
 CLASS_NAMES = [ 
@@ -33,6 +37,23 @@ CLASS_NAMES = [
 
 VALID_EXTENSIONS = ['jpg', 'png', 'gif', 'JPG']
 
+# pretrained COCO weights of Mask R-CNN
+WEIGHTS_PATH = 'mask_rcnn_coco.h5'
+
+# how inputs are resized before detection.
+# square: upsampled and padded to 1024x1024, as Mask R-CNN was trained
+# native: kept at their resolution and padded to multiples of 64
+# bucketed: padded to the smallest square of `IMAGE_SQUARE_SIZES` that fits
+MOLDING_PROFILES = {
+    'square': { 'IMAGE_RESIZE_MODE': 'square', 'IMAGE_MIN_DIM': 800 },
+    'native': { 'IMAGE_RESIZE_MODE': 'pad64', 'IMAGE_MIN_DIM': 0 },
+    'bucketed': { 'IMAGE_RESIZE_MODE': 'bucketed', 'IMAGE_MIN_DIM': 0 },
+}
+
+# loaded Mask R-CNN models shared across calls, keyed by configuration and weights
+DETECTORS = {}
+DETECTORS_LOCK = threading.Lock()
+
 # logger
 logger = logging.getLogger("Detector")
 logger.propagate = False
@@ -55,6 +76,68 @@ class InferenceConfig( mConfig.Config ):
     NUM_CLASSES = len( CLASS_NAMES )
 
 
+# configuration of the detector, without `masks` it is built without the mask head.
+# `profile` is one of `MOLDING_PROFILES`
+# `batchSize` images are detected in one forward pass. with `serving` the inference
+# graph is called directly instead of through `predict`
+def makeConfig( masks = True, profile = 'square', batchSize = 1, serving = False ):
+    config = InferenceConfig()
+    config.DETECTION_MASKS = masks
+    config.DETECTION_SERVING = serving
+    for attr, value in MOLDING_PROFILES[profile].items():
+        setattr( config, attr, value )
+    return batchConfig( config, batchSize )
+
+
+# copy of a configuration detecting `batchSize` images in one forward pass.
+# the batch size is computed when the configuration is created, so it is set on both
+def batchConfig( config, batchSize ):
+    config = copy.copy( config )
+    config.IMAGES_PER_GPU = batchSize
+    config.BATCH_SIZE = config.IMAGES_PER_GPU * config.GPU_COUNT
+    return config
+
+
+# hashable key describing every setting of a configuration
+def configKey( config ):
+    return tuple( ( a, str( getattr( config, a ) ) ) for a in dir( config ) if a.isupper() )
+
+
+# identifies the detector which produced a result, used to key cached detections.
+# the batch size and how the graph is called do not change results
+def modelVersion( config = None, weightsPath = WEIGHTS_PATH ):
+    if config is None:
+        config = InferenceConfig()
+    key = tuple( ( a, v ) for a, v in configKey( config )
+                 if a not in ( 'BATCH_SIZE', 'IMAGES_PER_GPU', 'DETECTION_SERVING' ) )
+    return ( os.path.basename( weightsPath ), key )
+
+
+# build and load a Mask R-CNN model once per process and reuse it afterwards
+def getModel( config = None, weightsPath = WEIGHTS_PATH ):
+    if config is None:
+        config = InferenceConfig()
+
+    key = ( configKey( config ), os.path.abspath( weightsPath ) )
+    with DETECTORS_LOCK:
+        if key not in DETECTORS:
+            start = time.perf_counter()
+
+            # initialize Mask R-CNN model for inference
+            logger.info( f'Loading Mask R-CNN model...' )
+            model = mModel.MaskRCNN( mode = 'inference', config = config, model_dir = os.getcwd() )
+
+            # load weight to model
+            logger.info( f'Loading pretrained COCO weights...' )
+            model.load_weights( filepath = weightsPath, by_name = True )
+            model.weightsPath = weightsPath
+
+            DETECTORS[key] = model
+            logger.info( f'Mask R-CNN model is ready in {time.perf_counter() - start:.2f}s' )
+
+        return DETECTORS[key]
+
+
 # resolve image path and return image
 def getImage( path = None ):
     # if it is called from command line, read path from system argument
@@ -81,6 +164,99 @@ def getImage( path = None ):
     return image
 
 
+# detect objects in decoded RGB images, returning one result dict per image
+def detectImages( images, model = None ):
+    if model is None:
+        model = getModel()
+
+    results = [ None ] * len( images )
+    for batch in detectionBatches( images, model.config ):
+        # the batch size is built into the graph, so a smaller last batch of a shape
+        # runs on a model of its size instead of being padded with copies
+        batchModel = model
+        if len( batch ) != model.config.BATCH_SIZE:
+            batchModel = getModel( batchConfig( model.config, len( batch ) ), model.weightsPath )
+        for i, res in zip( batch, batchModel.detect( [ images[i] for i in batch ], verbose = 0 ) ):
+            results[i] = res
+
+    return results
+
+
+# indices of images detected together, in batches of `BATCH_SIZE` images
+# which are molded to the same shape
+def detectionBatches( images, config ):
+    groups = {}
+    for i, im in enumerate( images ):
+        # square molding resizes every image to the same shape
+        shape = None if config.IMAGE_RESIZE_MODE == 'square' else im.shape
+        groups.setdefault( shape, [] ).append( i )
+
+    return [ indices[start:start + config.BATCH_SIZE]
+             for indices in groups.values() for start in range( 0, len( indices ), config.BATCH_SIZE ) ]
+
+
+# mean absolute difference between two grey frames
+def frameDifference( a, b ):
+    return float( np.mean( cv2.absdiff( a, b ) ) )
+
+
+# move boxes by the median optical flow inside each of them, clipped to the frame
+def propagateBoxes( rois, flow ):
+    height, width = flow.shape[:2]
+    moved = np.array( rois, np.int32 ).reshape( -1, 4 )
+    for box in moved:
+        y1, x1, y2, x2 = np.clip( box, 0, [ height, width, height, width ] )
+        if y2 <= y1 or x2 <= x1:
+            continue
+        dx, dy = np.median( flow[y1:y2, x1:x2].reshape( -1, 2 ), axis = 0 )
+        box += np.round( [ dy, dx, dy, dx ] ).astype( np.int32 )
+    moved[:, [0, 2]] = np.clip( moved[:, [0, 2]], 0, height )
+    moved[:, [1, 3]] = np.clip( moved[:, [1, 3]], 0, width )
+    return moved
+
+
+# objects of the previous frame moved along the optical flow, see `propagateBoxes`.
+# boxes clipped to an edge of the frame can be left without area, those objects are dropped
+def propagateObjects( objects, flow ):
+    rois = propagateBoxes( objects['rois'], flow )
+    keep = ( rois[:, 2] > rois[:, 0] ) & ( rois[:, 3] > rois[:, 1] )
+    return {
+        'rois': rois[keep],
+        'class_ids': np.asarray( objects['class_ids'] )[keep],
+        'scores': np.asarray( objects['scores'] )[keep],
+    }
+
+
+# detect objects only in keyframes of consecutive RGB frames and propagate their boxes to the
+# frames in between along the optical flow. a frame is a keyframe every `interval` frames, or
+# when its mean grey level differs from the last keyframe by more than `sceneThreshold`.
+# returns one result per frame, as `detectImages`, and the indices of the keyframes
+def detectKeyframes( images, model = None, interval = 5, sceneThreshold = 30.0 ):
+    if model is None:
+        model = getModel()
+
+    # keyframes only depend on the frames, so they are detected in batches first
+    greys = [ cv2.cvtColor( im, cv2.COLOR_RGB2GRAY ) for im in images ]
+    keyframes = []
+    for i, grey in enumerate( greys ):
+        keyGrey = greys[keyframes[-1]] if keyframes else None
+        if ( keyGrey is None or i - keyframes[-1] >= interval
+             or grey.shape != keyGrey.shape or frameDifference( grey, keyGrey ) > sceneThreshold ):
+            keyframes.append( i )
+    detected = dict( zip( keyframes, detectImages( [ images[i] for i in keyframes ], model ) ) )
+
+    results = []
+    for i, grey in enumerate( greys ):
+        if i in detected:
+            results.append( detected[i] )
+        else:
+            flow = cv2.calcOpticalFlowFarneback( greys[i - 1], grey, None, 0.5, 3, 15, 3, 5, 1.2, 0 )
+            results.append( propagateObjects( results[-1], flow ) )
+
+    logger.debug( f'Detected objects in {len(keyframes)} keyframes of {len(images)} frames' )
+    return results, keyframes
+
+
 # visualize results
 def visualize( image, result ):
     r = result
@@ -91,30 +267,31 @@ def visualize( image, result ):
     for s, c, b in zip( r['scores'], r['class_ids'], r['rois'] ):
         print( f'{s*100:.2f}% {CLASS_NAMES[ c ]:10} at {b}' )
 
+    # results of a boxes-only detector have no masks
+    masks = r.get( 'masks' )
+    showMask = masks is not None
+    if not showMask:
+        masks = np.zeros( image.shape[:2] + ( len( r['rois'] ), ), bool )
+
     mVisualize.display_instances( 
             image = image, 
             boxes = r['rois'], 
-            masks = r['masks'],
+            masks = masks,
             class_ids = r['class_ids'],
             class_names = CLASS_NAMES,
-            scores = r['scores'] 
+            scores = r['scores'],
+            show_mask = showMask,
+            show_mask_polygon = showMask
             )
 
     return
 
 
 # main execution
-def main( imagePath, outputDir, ignoreGIF = False ):
-    # initilize configuration and display it
-    config = InferenceConfig()
-
-    # initialize Mask R-CNN model for inference
-    logger.info( f'Loading Mask R-CNN model...' )
-    model = mModel.MaskRCNN( mode = 'inference', config = config, model_dir = os.getcwd() )
-
-    # load weight to model
-    logger.info( f'Loading pretrained COCO weights...' )
-    model.load_weights( filepath = 'mask_rcnn_coco.h5', by_name = True )
+def main( imagePath, outputDir, ignoreGIF = False, masks = True, batchSize = 1 ):
+    # get the Mask R-CNN model, it is only built on the first call.
+    # without `masks` the saved objects only hold boxes, class ids and scores
+    model = getModel( makeConfig( masks = masks, batchSize = batchSize ) )
 
     # get file name
     filename = imagePath.split(os.path.sep)[-1]
@@ -122,10 +299,12 @@ def main( imagePath, outputDir, ignoreGIF = False ):
     # make a directory to for storing detected objects
     tempDir = os.path.join( f'{outputDir}', '.tmp')
     pngDir = os.path.join( tempDir, os.path.splitext( filename )[0] )
-    objDir = os.path.join( pngDir, 'objects' )
-    if not os.path.exists( objDir ):
-        logger.debug( f'Creating temporary folder: {objDir} for storing detected objects...' )
-        os.makedirs( objDir )
+    if not os.path.exists( pngDir ):
+        logger.debug( f'Creating temporary folder: {pngDir} for storing detected objects...' )
+        os.makedirs( pngDir )
+
+    # objects of every frame are appended to a single file
+    objPath = os.path.join( pngDir, 'objects.det' )
 
     logger.info( f"Detecting objects in {filename}...." )
 
@@ -138,17 +317,15 @@ def main( imagePath, outputDir, ignoreGIF = False ):
         num_images = len( pngPaths )
 
         # detect objects
-        for i, p in enumerate( pngPaths ):
-            logger.debug(f"Detecting {len(pngPaths)} images and saving them to {objDir}....")
-
-            # forward pass
-            im = getImage( p )
-            res = model.detect( [im], verbose = 0 )
-            r = res[0] 
+        logger.debug(f"Detecting {len(pngPaths)} images and saving them to {objPath}....")
+        with ObjectsWriter( objPath, masks = masks ) as writer:
+            for start in range( 0, num_images, model.config.BATCH_SIZE ):
+                # forward pass, a batch of frames at a time
+                ims = [ getImage( p ) for p in pngPaths[start:start + model.config.BATCH_SIZE] ]
 
-            # save results
-            objFilename = f"{i + 1}.npy"
-            np.save( os.path.join( objDir, objFilename ), r )
+                # save results
+                for r in detectImages( ims, model ):
+                    writer.append( r )
 
     # transform image
     else:
@@ -157,9 +334,8 @@ def main( imagePath, outputDir, ignoreGIF = False ):
         im = getImage( preprocessedPath )
 
         # forward pass
-        res = model.detect( [im], verbose = 0 )
-        r = res[0] 
+        r = detectImages( [im], model )[0]
 
         # save results
-        objFilename = f"0.npy"
-        np.save( os.path.join( objDir, objFilename ), r )
+        with ObjectsWriter( objPath, masks = masks ) as writer:
+            writer.append( r )
@@ -0,0 +1,144 @@
+####################
+# This file stores detection results of all frames of an input in a single file.
+# Every object is a fixed-size record after a small header, so the file can be
+# memory-mapped and read without pickle, and frames can be appended one by one.
+# Instance masks are optional and kept run-length encoded in a sidecar file.
+
+
+import os
+import struct
+import numpy as np
+
+
+# magic, version, number of frames, image height and width
+HEADER = struct.Struct( '<4sIIII12x' )
+MAGIC = b'DETS'
+VERSION = 1
+
+# one detected object, `rle` locates its encoded mask in the sidecar file
+OBJECT_DTYPE = np.dtype( [
+    ( 'frame', '<u4' ),
+    ( 'class_id', '<i4' ),
+    ( 'score', '<f4' ),
+    ( 'roi', '<i4', ( 4, ) ),
+    ( 'rle_offset', '<u8' ),
+    ( 'rle_length', '<u4' ),
+] )
+
+RLE_DTYPE = np.dtype( '<i4' )
+
+
+# path of the mask sidecar of a detection file
+def masksPath( path ):
+    return f'{path}.rle'
+
+
+# run-length encoded masks of a result, cropped to their boxes
+def encodeMasks( result ):
+    masks = result['masks']
+    if hasattr( masks, 'to_rle' ):
+        return masks.to_rle()
+
+    # full size masks of older results
+    from mrcnn.utils import InstanceMasks
+    rois = np.asarray( result['rois'], np.int32 ).reshape( -1, 4 )
+    crops = [ masks[y1:y2, x1:x2, i] for i, ( y1, x1, y2, x2 ) in enumerate( rois ) ]
+    return InstanceMasks( crops, rois, masks.shape ).to_rle()
+
+
+# appends the results of consecutive frames to a detection file
+class ObjectsWriter( object ):
+    def __init__( self, path, masks = False ):
+        self.path = path
+        self.frames = 0
+        self.shape = ( 0, 0 )
+
+        self.file = open( path, 'wb' )
+        self.file.write( HEADER.pack( MAGIC, VERSION, 0, 0, 0 ) )
+        self.masks = open( masksPath( path ), 'wb' ) if masks else None
+
+
+    # write the objects of the next frame, then count the frame in the header
+    def append( self, result ):
+        records = np.zeros( len( result['scores'] ), OBJECT_DTYPE )
+        records['frame'] = self.frames
+        records['class_id'] = result['class_ids']
+        records['score'] = result['scores']
+        records['roi'] = np.asarray( result['rois'], np.int32 ).reshape( -1, 4 )
+
+        if self.masks is not None and 'masks' in result:
+            self.shape = tuple( result['masks'].shape[:2] )
+            for i, runs in enumerate( encodeMasks( result ) ):
+                records['rle_offset'][i] = self.masks.tell() // RLE_DTYPE.itemsize
+                records['rle_length'][i] = len( runs )
+                self.masks.write( runs.astype( RLE_DTYPE ).tobytes() )
+            self.masks.flush()
+
+        self.file.write( records.tobytes() )
+        self.frames += 1
+
+        # readers only trust frames counted in the header
+        self.file.seek( 0 )
+        self.file.write( HEADER.pack( MAGIC, VERSION, self.frames, *self.shape ) )
+        self.file.seek( 0, os.SEEK_END )
+        self.file.flush()
+        return
+
+
+    def close( self ):
+        self.file.close()
+        if self.masks is not None:
+            self.masks.close()
+
+
+    def __enter__( self ):
+        return self
+
+
+    def __exit__( self, *exc ):
+        self.close()
+
+
+# read the records of a detection file, memory-mapped unless `mmap` is false.
+# returns the number of frames, the image shape and the records
+def readObjects( path, mmap = True ):
+    with open( path, 'rb' ) as f:
+        magic, version, frames, height, width = HEADER.unpack( f.read( HEADER.size ) )
+    if magic != MAGIC or version != VERSION:
+        raise ValueError( f'{path} is not a detection file' )
+
+    # ignore a record which was being written when the file was read
+    count = ( os.path.getsize( path ) - HEADER.size ) // OBJECT_DTYPE.itemsize
+    if count == 0:
+        records = np.zeros( 0, OBJECT_DTYPE )
+    elif mmap:
+        records = np.memmap( path, OBJECT_DTYPE, mode = 'r', offset = HEADER.size, shape = ( count, ) )
+    else:
+        records = np.fromfile( path, OBJECT_DTYPE, count = count, offset = HEADER.size )
+
+    # records are written in frame order, slicing keeps the memory map
+    return frames, ( height, width ), records[:np.searchsorted( records['frame'], frames )]
+
+
+# load a detection file as one result dict per frame, like `detect.detectImages` returns.
+# with `masks`, instance masks are decoded from the sidecar file if it exists
+def loadObjects( path, mmap = True, masks = False ):
+    frames, shape, records = readObjects( path, mmap )
+
+    rle = None
+    if masks and os.path.exists( masksPath( path ) ):
+        from mrcnn.utils import InstanceMasks
+        rle = np.memmap( masksPath( path ), RLE_DTYPE, mode = 'r' ) if os.path.getsize( masksPath( path ) ) \
+            else np.zeros( 0, RLE_DTYPE )
+
+    offsets = np.searchsorted( records['frame'], np.arange( frames + 1 ) )
+    objects = []
+    for start, end in zip( offsets[:-1], offsets[1:] ):
+        r = records[start:end]
+        result = { 'rois': r['roi'], 'class_ids': r['class_id'], 'scores': r['score'] }
+        if rle is not None and ( r['rle_length'] > 0 ).all():
+            runs = [ rle[o:o + n] for o, n in zip( r['rle_offset'], r['rle_length'] ) ]
+            result['masks'] = InstanceMasks.from_rle( runs, r['roi'], shape )
+        objects.append( result )
+
+    return objects
@@ -7,16 +7,22 @@
 
 import os
 import sys
-import PIL
+import time
 import glob
-import imageio
 import logging
 import argparse
 from tqdm import tqdm
 from datetime import datetime
-from cartoonize import main as cartoonize
-from detect import main as detect
-from enhance import main as enhance
+from cartoonize import MODEL_CACHE
+from cartoonize import TRACE_STATS
+from cartoonize import get_model as getCartoonModel
+from detect import getModel as getDetector
+from pipeline import Pipeline
+from pipeline import StreamingPipeline
+from pipeline import ProcessPoolPipeline
+from pipeline import configureThreads
+from pipeline import VIDEO_EXTENSIONS
+from encoder import GIF_PALETTES
 
 
 #---------- constants ----------# 
@@ -24,7 +30,7 @@ from enhance import main as enhance
 
 STYLES = ['shinkai', 'hayao', 'hosoda', 'paprika']
 EDGES = ['adaptive', 'canny', 'morph', 'original']
-VALID_EXTENSIONS = ['jpg', 'png', 'gif', 'JPG']
+VALID_EXTENSIONS = ['jpg', 'png', 'gif', 'JPG'] + VIDEO_EXTENSIONS
 
 
 #----------configuration arguments ----------#
@@ -62,6 +68,15 @@ parser.add_argument('--gif_frame_frequency', type=int, default=1,
 parser.add_argument('--max_num_frames', type=int, default=100,
                     help='max number of frames that will be extracted from a gif. set higher value if longer gif '
                          'is needed')
+parser.add_argument('--gif_palette', type=str, default='frame', choices=GIF_PALETTES,
+                    help='`frame` quantizes every frame of an output gif to its own palette. `global` shares one '
+                         'palette computed from sampled frames, which is faster, avoids flickering flat colors '
+                         'and lets unchanged areas be skipped')
+parser.add_argument('--gif_workers', type=int, default=4,
+                    help='threads quantizing the frames of a gif when `gif_palette` is `global`')
+parser.add_argument('--video_chunk', type=int, default=32,
+                    help='number of video frames decoded, transformed and appended to the output videos at a time. '
+                         'memory use depends on this rather than on the length of the video')
 parser.add_argument('--keep_original_size', action='store_true',
                     help='by default the input images will be resized to reasonable size to prevent potential large '
                          'computation and to save file sizes. Enable this if you want the original image size.')
@@ -70,23 +85,97 @@ parser.add_argument('--max_resized_height', type=int, default=300,
                          'aspect ratio. Set higher value or enable `keep_original_size` if you want larger image.')
 parser.add_argument('--convert_gif_to_mp4', action='store_true',
                     help='convert transformed gif to mp4 which is much more smaller and easier to share. '
-                         '`ffmpeg` need to be installed at first.')
+                         'it is encoded from the same frames as the gif with `imageio-ffmpeg`.')
 parser.add_argument('--logging_lvl', type=str, default='info',
                     choices=['debug', 'info', 'warning', 'error', 'critical'],
                     help='logging level which decide how verbosely the program will be. set to `debug` if necessary')
 parser.add_argument('--debug', action='store_true',
                     help='show the most detailed logging messages for debugging purpose')
+parser.add_argument('--cartoon_bucket', type=int, default=0,
+                    help='pad images up to multiples of this size so that images of different sizes can be '
+                         'cartoonized in the same batch. 0 only batches images of exactly the same size')
+parser.add_argument('--trace_bucket', type=int, default=0,
+                    help='run CartoonGAN through one traced function per size bucket, padding images up to '
+                         'multiples of this size, so that new resolutions reuse a traced graph. 0 calls the model '
+                         'eagerly')
+parser.add_argument('--model_cache_mb', type=float, default=1024,
+                    help='memory budget in MB for CartoonGAN models kept loaded between images. least recently used '
+                         'styles are unloaded when the budget is exceeded')
+parser.add_argument('--streaming', action='store_true',
+                    help='run decoding, detection, cartoonization, enhancement and writing on separate workers so '
+                         'that consecutive images overlap. recommended for directories with many images')
+parser.add_argument('--queue_size', type=int, default=4,
+                    help='max number of images waiting between two stages when `streaming` is enabled')
+parser.add_argument('--concurrent_stages', action='store_true',
+                    help='detect objects and cartoonize with every style at the same time, since they only depend '
+                         'on the input image. reduces the time taken for a single image')
+parser.add_argument('--boxes_only', action='store_true',
+                    help='build Mask R-CNN without its mask head. edge enhancement only uses the detected boxes, '
+                         'so the results are the same and detection is faster')
+parser.add_argument('--detect_profile', type=str, default='square', choices=['square', 'native', 'bucketed'],
+                    help='how images are resized for Mask R-CNN. `square` upsamples them to 1024x1024, `native` '
+                         'only pads them to multiples of 64 and `bucketed` pads them to the smallest fitting square '
+                         'of a few sizes. the last two are much faster on small images')
+parser.add_argument('--detect_batch', type=int, default=1,
+                    help='number of frames or images of the same shape detected in one Mask R-CNN forward pass. '
+                         'the detect stage takes up to this many waiting inputs at once')
+parser.add_argument('--detect_serving', action='store_true',
+                    help='call the Mask R-CNN inference graph through a tf.function traced once per molded shape '
+                         'instead of through keras `predict`, which has a fixed overhead on every call')
+parser.add_argument('--roi_workers', type=int, default=0,
+                    help='threads extracting the edges of the objects of a frame in parallel. 0 or 1 extracts '
+                         'them one after another')
+parser.add_argument('--roi_merge_iou', type=float, default=0,
+                    help='merge boxes of objects overlapping by at least this intersection over union before '
+                         'extracting their edges, so crowded areas are processed once. 0 keeps every box')
+parser.add_argument('--dedup', type=str, default='exact', choices=['none', 'exact', 'perceptual'],
+                    help='process repeated gif frames only once. `exact` drops identical frames, `perceptual` '
+                         'also frames which look alike, see `dedup_distance`')
+parser.add_argument('--dedup_distance', type=int, default=2,
+                    help='max number of differing bits of the 64 bit perceptual hashes of two frames which are '
+                         'considered the same when `dedup` is `perceptual`')
+parser.add_argument('--keyframe_interval', type=int, default=1,
+                    help='detect objects in every n-th frame of a gif only, and move the boxes along the optical '
+                         'flow in the frames in between. 1 detects objects in every frame')
+parser.add_argument('--scene_threshold', type=float, default=30,
+                    help='mean grey level difference to the last keyframe above which a frame is detected anyway, '
+                         'when `keyframe_interval` is above 1')
+parser.add_argument('--tile_size', type=int, default=0,
+                    help='cartoonize images larger than this in overlapping tiles of this size, which bounds the '
+                         'memory used by full resolution images. 0 always transforms whole images')
+parser.add_argument('--tile_overlap', type=int, default=32,
+                    help='pixels shared by neighboring tiles when `tile_size` is set, blended to hide the seams')
+parser.add_argument('--concurrent_styles', action='store_true',
+                    help='run every requested style at the same time on the input, which is preprocessed once '
+                         'and shared by the styles')
+parser.add_argument('--intra_op_threads', type=int, default=0,
+                    help='threads used by a single TensorFlow operation. 0 lets TensorFlow decide. lower it when '
+                         '`concurrent_stages` is enabled so that the models do not compete for cores')
+parser.add_argument('--inter_op_threads', type=int, default=0,
+                    help='TensorFlow operations that may run at the same time. 0 lets TensorFlow decide')
+parser.add_argument('--num_workers', type=int, default=0,
+                    help='number of worker processes, each loading its own copy of the models and transforming '
+                         'images from a shared queue, so memory grows with every worker. 0 transforms every image '
+                         'in this process')
+parser.add_argument('--cache_dir', type=str, default='',
+                    help='directory of the result cache, keyed on the content of the inputs and the parameters '
+                         'used. defaults to `.cache` inside `output_dir`')
+parser.add_argument('--no_cache', action='store_true',
+                    help='neither read nor write cached detections, cartoons and enhanced images')
+parser.add_argument('--cache_mb', type=float, default=2048,
+                    help='disk budget in MB of the result cache. least recently used entries are removed when the '
+                         'budget is exceeded')
+parser.add_argument('--cache_enhanced', action='store_true',
+                    help='also cache enhanced images. they are copies of the written outputs, so only detections '
+                         'and cartoons are cached by default')
+parser.add_argument('--no_manifest', action='store_true',
+                    help='do not keep `manifest.sqlite` in `output_dir`. by default finished images are recorded '
+                         'there, and a restarted run skips them unless `overwrite` is enabled')
 parser.add_argument('--show_tf_cpp_log', action='store_true')
 
 args = parser.parse_args()
 
 
-#---------- derived constants ----------#
-
-
-TEMPORARY_DIR = os.path.join( f'{args.output_dir}', '.tmp' )
-
-
 #---------- logger configs ----------#
 
 
@@ -120,96 +209,18 @@ def handle_args( funArgs ):
     return
 
 
-def preprocess( imagePath ):
-    logger.debug(f"`{imagePath}` is an image, preprocess the image from it...")
-
-    # determine where to save
-    filename = imagePath.split(os.path.sep)[-1]
-    saveDir = os.path.join(TEMPORARY_DIR, os.path.splitext( filename )[0] )
-    if not os.path.exists(saveDir):
-        logger.debug(f"Creating temporary folder: {saveDir} for storing preprocessed image...")
-        os.makedirs(saveDir)
-
-    # preprocess
-    input_image = PIL.Image.open( imagePath ).convert("RGB")
-    if not args.keep_original_size:
-        width, height = input_image.size
-        aspect_ratio = width / height
-        resized_height = min(height, args.max_resized_height)
-        resized_width = int(resized_height * aspect_ratio)
-        if width != resized_width:
-            logger.debug(f"resized ({width}, {height}) to: ({resized_width}, {resized_height})")
-            input_image = input_image.resize((resized_width, resized_height))
-    input_image.save( os.path.join( saveDir, filename ) )
-
-    return input_image
-
-
-def convert_gif_to_png(gif_path):
-    logger.debug(f"`{gif_path}` is a gif, extracting png images from it...")
-    gif_filename = gif_path.split(os.path.sep)[-1].replace(".gif", "")
-    image = PIL.Image.open(gif_path)
-    # palette = image.getpalette()
-    png_paths = list()
-    i = 0
-
-    png_dir = os.path.join(TEMPORARY_DIR, gif_filename)
-    if not os.path.exists(png_dir):
-        logger.debug(f"Creating temporary folder: {png_dir} for storing separated pngs from gif...")
-        os.makedirs(png_dir)
-
-    prev_generated_png_paths = glob.glob(png_dir + '/*.png')
-    if prev_generated_png_paths:
-        return prev_generated_png_paths
-
-    if( not args.ignore_gif ):
-        num_processed_frames = 0
-        logger.debug("Generating png images...")
-        try:
-            while num_processed_frames < args.max_num_frames:
-                # image.putpalette(palette)
-                extracted_image = PIL.Image.new("RGBA", image.size)
-                extracted_image.paste(image)
-
-                if not args.keep_original_size:
-                    width, height = extracted_image.size
-                    aspect_ratio = width / height
-                    resized_height = min(height, args.max_resized_height)
-                    resized_width = int(resized_height * aspect_ratio)
-                    if width != resized_width:
-                        logger.debug(f"resized ({width}, {height}) to: ({resized_width}, {resized_height})")
-                        extracted_image = extracted_image.resize((resized_width, resized_height))
-
-                if i % args.gif_frame_frequency == 0:
-                    png_filename = f"{i + 1}.png"
-                    png_path = os.path.join(png_dir, png_filename)
-                    extracted_image.save(png_path)
-                    png_paths.append(png_path)
-                    num_processed_frames += 1
-
-                image.seek(image.tell() + 1)
-                i += 1
-
-        except EOFError:
-            pass  # end of sequence
-
-    else:
-        # image.putpalette(palette)
-        extracted_image = PIL.Image.new("RGBA", image.size)
-        extracted_image.paste(image)
-
-        if not args.keep_original_size:
-            width, height = extracted_image.size
-            aspect_ratio = width / height
-            resized_height = min(height, args.max_resized_height)
-            resized_width = int(resized_height * aspect_ratio)
-            if width != resized_width:
-                logger.debug(f"resized ({width}, {height}) to: ({resized_width}, {resized_height})")
-                extracted_image = extracted_image.resize((resized_width, resized_height))
-
+# summarize how long each image took, separating the one-off model startup
+def reportLatency( startup, latencies ):
+    logger.info( f"Model startup time: {startup:.2f}s" )
+    if not latencies:
+        return
 
-    logger.debug(f"Number of {len(png_paths)} png images were generated at {png_dir}.")
-    return png_paths
+    steady = latencies[1:] if len( latencies ) > 1 else latencies
+    logger.info( f"Per-image latency over {len(latencies)} images: "
+                 f"first {latencies[0]:.2f}s, "
+                 f"mean {sum(steady) / len(steady):.2f}s, "
+                 f"max {max(steady):.2f}s after the first image" )
+    return
 
 
 #---------- main execution ----------#
@@ -223,10 +234,6 @@ def main():
     if not os.path.exists( args.output_dir ):
         os.makedirs( args.output_dir )
 
-    # create temporary folder which will be deleted after transformations
-    if not os.path.exists( TEMPORARY_DIR ):
-        os.makedirs( TEMPORARY_DIR )
-
     # decide what styles to used in this execution
     styles = STYLES if args.all_styles else args.styles
     args.styles = styles
@@ -245,47 +252,66 @@ def main():
         imagePaths.append( args.input )
         logger.info(f'Preparing to transform `{args.input}` file...')
 
+    if args.ignore_gif:
+        imagePaths = [ p for p in imagePaths if not p.endswith( '.gif' ) ]
+
+    configureThreads( args.intra_op_threads, args.inter_op_threads )
+    if args.num_workers > 0:
+        pipeline = ProcessPoolPipeline( args )
+    elif args.streaming:
+        pipeline = StreamingPipeline( args )
+    else:
+        pipeline = Pipeline( args )
+
+    # build the models once up front so that images only pay for inference.
+    # worker processes build their own, TensorFlow does not run in the parent then
+    startupStart = time.perf_counter()
+    if args.num_workers == 0:
+        getDetector( pipeline.detectorConfig )
+        for s in styles:
+            getCartoonModel( s )
+    startup = time.perf_counter() - startupStart
+
     # transform each image
-    progressBar = tqdm( imagePaths, desc='Transforming' )
-    for imagePath in progressBar:
-        filename = imagePath.split( os.path.sep )[-1]
-        progressBar.set_postfix( File = filename )
-
-        # preprocess
-        if( filename.endswith(".gif") ):
-            convert_gif_to_png( imagePath )
-        else:
-            preprocess( imagePath )
-
-        detect( imagePath, args.output_dir )
-        cartoonize( imagePath, args )
-        enhance( imagePath, args.output_dir, args.edges, args.styles )
-
-        # construct and save gif
-        if( filename.endswith(".gif") ):
-            for s in args.styles:
-                for e in args.edges:
-                    # find enhanced cartoon images
-                    pngDir = os.path.join( TEMPORARY_DIR, os.path.splitext( filename )[0] )
-                    enhancedDir = os.path.join( pngDir, s, e, 'enhanced' )
-                    enhancedPaths = []
-                    enhancedPaths.extend( glob.glob( os.path.join( enhancedDir, f"*.png" ) ) )
-
-                    # determine path to save
-                    saveDir = os.path.join( args.output_dir, s, e )
-                    if not os.path.exists( saveDir ):
-                        os.makedirs( saveDir )
-                    savePath = os.path.join( saveDir, filename )
-
-                    with imageio.get_writer( savePath, mode='I' ) as writer:
-                        file_names = sorted( enhancedPaths, key=lambda x: int(x.split('/')[-1].replace('.png', '')) )
-                        logger.debug(f"Combining {len(file_names)} png images into {savePath}...")
-                        for i, fn in enumerate(file_names):
-                            image = imageio.imread(fn)
-                            writer.append_data(image)
+    latencies = []
+    if args.num_workers > 0 or args.streaming:
+        progressBar = tqdm( total = len( imagePaths ), desc='Transforming' )
+        jobs = pipeline.runAll( imagePaths, progressBar )
+        latencies = [ j.latency for j in jobs if not j.skipped ]
+    else:
+        # images are processed `batch_size` at a time so that CartoonGAN sees full batches
+        progressBar = tqdm( total = len( imagePaths ), desc='Transforming' )
+        for i in range( 0, len( imagePaths ), args.batch_size ):
+            batchPaths = imagePaths[i:i + args.batch_size]
+            progressBar.set_postfix( File = batchPaths[0].split( os.path.sep )[-1] )
+
+            # stages hand their results to each other in memory
+            jobs = pipeline.runMany( batchPaths )
+            latencies.extend( [ j.latency for j in jobs if not j.skipped ] )
+            progressBar.update( len( batchPaths ) )
 
     # ending
     progressBar.close()
+    reportLatency( startup, latencies )
+    stats = MODEL_CACHE.stats()
+    logger.info( f"CartoonGAN model cache: {stats['hits']} hits, {stats['misses']} misses, "
+                 f"{stats['evictions']} evictions, {len(stats['resident'])} models resident "
+                 f"({stats['resident_mb']:.0f}/{stats['budget_mb']:.0f} MB)" )
+    if args.trace_bucket:
+        logger.info( f"CartoonGAN traced {TRACE_STATS['traces']} functions for {TRACE_STATS['calls']} calls" )
+    if pipeline.manifest is not None and pipeline.manifest.skipped:
+        logger.info( f"Skipped {pipeline.manifest.skipped} images finished by a previous run, "
+                     f"saving {pipeline.manifest.savedSeconds:.2f}s of recorded work" )
+    if pipeline.droppedFrames:
+        logger.info( f"Dropped {pipeline.droppedFrames} repeated frames of {pipeline.decodedFrames} gif frames" )
+    if pipeline.detectorCalls < pipeline.detectedFrames:
+        logger.info( f"Detector ran on {pipeline.detectorCalls} of {pipeline.detectedFrames} frames, "
+                     f"saving {pipeline.detectedFrames - pipeline.detectorCalls} calls" )
+    if pipeline.cache is not None:
+        for kind, ( hits, misses ) in pipeline.cache.stats().items():
+            logger.info( f"Result cache for {kind}: {hits} hits, {misses} misses" )
+        logger.info( f"Result cache holds {pipeline.cache.residentBytes() / 1024 ** 2:.0f}/{args.cache_mb:.0f} MB, "
+                     f"{pipeline.cache.evictions} entries evicted" )
     elapsed = datetime.now() - start
     logger.info( f"Total processing time: {elapsed}" )
 
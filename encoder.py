@@ -0,0 +1,137 @@
+####################
+# This file encodes frames held in memory into gif and mp4 files while they are produced.
+# Both formats are fed from the same frames in a single pass, so no intermediate images
+# are written and finished gifs are never decoded again to convert them.
+
+
+import os
+import threading
+import imageio
+import numpy as np
+import PIL.Image
+from concurrent.futures import ThreadPoolExecutor
+
+
+# frame rate of gifs, as written by imageio by default
+GIF_FPS = 10
+
+# how gif frames are quantized to 256 colors.
+# frame: every frame gets its own palette, as imageio writes them
+# global: one palette from sampled frames is shared by every frame
+GIF_PALETTES = ['frame', 'global']
+
+
+# mp4 next to a gif, in an `mp4` folder of the gif's folder
+def mp4Path( gifPath ):
+    name = os.path.splitext( os.path.basename( gifPath ) )[0]
+    return os.path.join( os.path.dirname( gifPath ), 'mp4', f'{name}.mp4' )
+
+
+# one palette of `colors` colors for up to `samples` frames spread over the clip
+def globalPalette( frames, samples = 16, colors = 256 ):
+    step = max( 1, len( frames ) // samples )
+    sampled = [ f for f in frames[::step][:samples] if f.shape == frames[0].shape ]
+    mosaic = PIL.Image.fromarray( np.concatenate( sampled, axis = 0 ) )
+    return mosaic.quantize( colors = colors, method = PIL.Image.MEDIANCUT )
+
+
+# write RGB frames as a gif whose frames share one palette. frames are quantized on
+# `workers` threads, and Pillow only stores the area that changed from the previous
+# frame, which a shared palette keeps small for flat cartoon colors
+def writeGif( frames, path, fps = GIF_FPS, workers = 4 ):
+    palette = globalPalette( frames )
+
+    def quantize( frame ):
+        return PIL.Image.fromarray( frame ).quantize( palette = palette, dither = 0 )
+
+    if workers > 1 and len( frames ) > 1:
+        with ThreadPoolExecutor( max_workers = workers ) as executor:
+            images = list( executor.map( quantize, frames ) )
+    else:
+        images = [ quantize( f ) for f in frames ]
+
+    images[0].save( path, format = 'GIF', save_all = True, append_images = images[1:],
+                    duration = int( round( 1000 / fps ) ), loop = 0, optimize = False )
+    return path
+
+
+# streams frames to a gif and/or an mp4 writer. files are written under temporary names
+# and only replace their outputs once `close` is called, so they are never left truncated
+class FrameEncoder( object ):
+    # with a `global` palette the gif is encoded by `writeGif` on close,
+    # from the frames kept until then
+    def __init__( self, gifPath = None, mp4Path = None, fps = GIF_FPS, crf = 25, gifPalette = 'frame', workers = 4 ):
+        self.outputs = []
+        self.frames = 0
+        self.fps = fps
+        self.workers = workers
+        self.gif = None
+        self.gifFrames = []
+        if gifPath is not None and gifPalette == 'global':
+            self.gif = ( self.tmpPath( gifPath ), gifPath )
+        elif gifPath is not None:
+            # gifs are written by imageio's Pillow plugin, which takes the frame duration in ms
+            self.open( gifPath, mode = 'I', duration = int( round( 1000 / fps ) ), loop = 0 )
+        if mp4Path is not None:
+            # libx264 needs even sizes, macro_block_size = 2 rounds them like ffmpeg's scale filter
+            self.open( mp4Path, fps = fps, codec = 'libx264', pixelformat = 'yuv420p', quality = None,
+                       macro_block_size = 2, ffmpeg_params = [ '-crf', str( crf ), '-movflags', 'faststart' ] )
+
+
+    # temporary name of an output in its folder, which is created if needed
+    def tmpPath( self, path ):
+        saveDir = os.path.dirname( path )
+        if saveDir and not os.path.exists( saveDir ):
+            os.makedirs( saveDir, exist_ok = True )
+        return os.path.join( saveDir, f'.{os.getpid()}.{threading.get_ident()}.{os.path.basename( path )}' )
+
+
+    def open( self, path, **kwargs ):
+        tmpPath = self.tmpPath( path )
+        self.outputs.append( ( imageio.get_writer( tmpPath, **kwargs ), tmpPath, path ) )
+
+
+    # encode the next RGB frame into every output
+    def append( self, frame ):
+        for writer, _, _ in self.outputs:
+            writer.append_data( frame )
+        if self.gif is not None:
+            self.gifFrames.append( frame )
+        self.frames += 1
+
+
+    # finish the files and move them to their outputs
+    def close( self ):
+        paths = []
+        for writer, tmpPath, path in self.outputs:
+            writer.close()
+            os.replace( tmpPath, path )
+            paths.append( path )
+
+        if self.gif is not None and self.gifFrames:
+            tmpPath, path = self.gif
+            writeGif( self.gifFrames, tmpPath, self.fps, self.workers )
+            os.replace( tmpPath, path )
+            self.gifFrames = []
+            paths.append( path )
+        return paths
+
+
+    # drop the partially written files
+    def abort( self ):
+        for writer, tmpPath, _ in self.outputs:
+            writer.close()
+            if os.path.exists( tmpPath ):
+                os.remove( tmpPath )
+        self.gifFrames = []
+
+
+    def __enter__( self ):
+        return self
+
+
+    def __exit__( self, excType, exc, traceback ):
+        if excType is None:
+            self.close()
+        else:
+            self.abort()
@@ -9,7 +9,10 @@ import os
 import sys
 import glob
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from detect import main as detect
+from detections import loadObjects
 
 
 IMAGE_PATH = './input/nyc.png'
@@ -31,117 +34,222 @@ stdhandler.setFormatter(formatter)
 logger.addHandler(stdhandler)
 
 
-# get canny edges in each of the region of interest
-def getCannyEdge( objects, cartoon ):
-    # pre-process
-    edges = np.zeros( cartoon.shape[:2], np.uint8 )
-    grey = cv2.cvtColor( cartoon, cv2.COLOR_BGR2GRAY )
-    blur = cv2.GaussianBlur( grey, ( 5, 5 ), 0 )
-
-    # for each region of interest with score larger than 90%
-    for score, roi in zip( objects['scores'], objects['rois'] ):
-        if( score > 0.9 ):
-            # clip to the region
-            region = blur[ roi[0] : roi[2], roi[1] : roi[3] ]
-
-            # edge detection
-            highThresh, _ = cv2.threshold( region, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU )
-            lowThresh = highThresh * 0.75
-            edge = cv2.Canny( region, lowThresh, highThresh )
-
-            # edge refinement
-            kern = np.ones( ( 3, 3 ), np.uint8 )
-            dilate = cv2.dilate( edge, kern )
-            erode = cv2.erode( dilate, kern )
-
-            # find contour
-            cont, hier = cv2.findContours( erode, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE )
-            edge = cv2.drawContours( np.zeros( region.shape[:2], np.uint8 ), cont, -1, 255, 1 )
-
-            # place regional edge to the whole picture
+# structuring element of the edge refinements
+KERNEL = np.ones( ( 3, 3 ), np.uint8 )
+
+# thread pools for the edges of regions, shared by every frame and keyed by their size
+EXECUTORS = {}
+EXECUTORS_LOCK = threading.Lock()
+
+
+# thread pool with `workers` threads, None runs regions one after another.
+# OpenCV releases the GIL, so regions of a frame are processed in parallel
+def getExecutor( workers ):
+    if workers <= 1:
+        return None
+
+    with EXECUTORS_LOCK:
+        if workers not in EXECUTORS:
+            EXECUTORS[workers] = ThreadPoolExecutor( max_workers = workers, thread_name_prefix = 'roi' )
+        return EXECUTORS[workers]
+
+
+# intersection over union of one box with each of several boxes
+def boxIoU( box, boxes ):
+    y1 = np.maximum( box[0], boxes[:, 0] )
+    x1 = np.maximum( box[1], boxes[:, 1] )
+    y2 = np.minimum( box[2], boxes[:, 2] )
+    x2 = np.minimum( box[3], boxes[:, 3] )
+    intersection = np.maximum( y2 - y1, 0 ) * np.maximum( x2 - x1, 0 )
+    area = ( box[2] - box[0] ) * ( box[3] - box[1] )
+    areas = ( boxes[:, 2] - boxes[:, 0] ) * ( boxes[:, 3] - boxes[:, 1] )
+    return intersection / np.maximum( area + areas - intersection, 1 )
+
+
+# replace boxes overlapping by at least `minIoU` with their union until no such pair is left,
+# so overlapping regions are processed once. the union takes the place of the first box
+def mergeBoxes( rois, minIoU ):
+    boxes = [ np.asarray( roi, np.int64 ) for roi in rois ]
+    merged = True
+    while merged and len( boxes ) > 1:
+        merged = False
+        for i in range( len( boxes ) ):
+            overlaps = boxIoU( boxes[i], np.stack( boxes[i + 1:] ) ) if i + 1 < len( boxes ) else []
+            matches = [ i + 1 + j for j, iou in enumerate( overlaps ) if iou >= minIoU ]
+            if matches:
+                group = np.stack( [ boxes[i] ] + [ boxes[j] for j in matches ] )
+                boxes[i] = np.concatenate( [ group[:, :2].min( axis = 0 ), group[:, 2:].max( axis = 0 ) ] )
+                boxes = [ b for j, b in enumerate( boxes ) if j not in matches ]
+                merged = True
+                break
+
+    return boxes
+
+
+# edges of every method for one BGR cartoon frame. the grey image, its blur, the
+# regions of interest and their Otsu thresholds are computed once and shared by the methods.
+# regions are processed on `workers` threads, and regions overlapping by at least
+# `mergeIoU` are merged first. 0 disables either
+class FrameEdges( object ):
+    def __init__( self, objects, cartoon, workers = 0, mergeIoU = 0 ):
+        self.cartoon = cartoon
+        self.grey = cv2.cvtColor( cartoon, cv2.COLOR_BGR2GRAY )
+        self.executor = getExecutor( workers )
+        self._blur = None
+        self._otsu = {}
+
+        # regions of interest with score larger than 90%
+        self.rois = [ roi for score, roi in zip( objects['scores'], objects['rois'] ) if score > 0.9 ]
+        if mergeIoU > 0:
+            self.rois = mergeBoxes( self.rois, mergeIoU )
+
+
+    # gaussian blur of the whole grey image, only needed by canny
+    @property
+    def blur( self ):
+        if self._blur is None:
+            self._blur = cv2.GaussianBlur( self.grey, ( 5, 5 ), 0 )
+        return self._blur
+
+
+    # Otsu threshold and thresholded region `i` of the grey or blurred image
+    def otsu( self, i, blurred = False ):
+        key = ( i, blurred )
+        if key not in self._otsu:
+            self._otsu[key] = cv2.threshold( self.region( i, blurred ), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU )
+        return self._otsu[key]
+
+
+    # clip region `i` of the grey or blurred image
+    def region( self, i, blurred = False ):
+        roi = self.rois[i]
+        image = self.blur if blurred else self.grey
+        return image[ roi[0] : roi[2], roi[1] : roi[3] ]
+
+
+    # compute the edge of every region and place them in the whole picture.
+    # they are placed in order, so later regions still overwrite earlier ones.
+    # empty regions, of boxes without area inside the picture, are skipped
+    def regionEdges( self, regionEdge ):
+        edges = np.zeros( self.grey.shape, np.uint8 )
+        indices = [ i for i in range( len( self.rois ) ) if self.region( i ).size ]
+        if self.executor is not None and len( indices ) > 1:
+            regional = self.executor.map( regionEdge, indices )
+        else:
+            regional = map( regionEdge, indices )
+
+        for i, edge in zip( indices, regional ):
+            roi = self.rois[i]
             edges[ roi[0] : roi[2], roi[1] : roi[3] ] = edge
-            # edges = cv2.rectangle( edges, ( roi[1], roi[0] ), ( roi[3], roi[2] ), 127, 1 )
+        return edges
+
+
+    # get canny edges in each of the region of interest
+    def canny( self ):
+        # blur once before the regions share it
+        self.blur
+        return self.regionEdges( self.cannyRegion )
+
+
+    def cannyRegion( self, i ):
+        region = self.region( i, blurred = True )
+
+        # edge detection
+        highThresh, _ = self.otsu( i, blurred = True )
+        lowThresh = highThresh * 0.75
+        edge = cv2.Canny( region, lowThresh, highThresh )
+
+        # edge refinement
+        dilate = cv2.dilate( edge, KERNEL )
+        erode = cv2.erode( dilate, KERNEL )
+
+        # find contour
+        cont, hier = cv2.findContours( erode, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE )
+        return cv2.drawContours( np.zeros( region.shape[:2], np.uint8 ), cont, -1, 255, 1 )
+
+
+    # get morphologic edge in each of the region of interest
+    def morph( self ):
+        return self.regionEdges( self.morphRegion )
+
+
+    def morphRegion( self, i ):
+        # threshold edges
+        _, thresh = self.otsu( i )
+
+        # difference between dilated and thresholded region to get actual edges
+        dilate = cv2.dilate( thresh, KERNEL )
+        return cv2.absdiff( dilate, thresh )
+
 
-    return edges
+    # get adaptive edge in each of the region of interest
+    def adaptive( self ):
+        return self.regionEdges( self.adaptiveRegion )
+
+
+    def adaptiveRegion( self, i ):
+        # parameters to be tuned
+        roi = self.rois[i]
+        area = ( roi[2] - roi[0] ) * ( roi[3] - roi[1] )
+        lineSize = max( round( ( ( area ** 0.5 ) / 61.8 - 1 ) / 2 ) * 2 + 1, 3 )    # has to be odd
+        blurSize = 5
+
+        blur = cv2.medianBlur( self.region( i ), blurSize )
+
+        # threshold edges
+        edge = cv2.adaptiveThreshold( blur, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, lineSize, blurSize )
+        return 255 - edge
+
+
+    # edge image and enhanced cartoon of one method
+    def enhance( self, method ):
+        if method == EDGES[3]:
+            return np.zeros( self.grey.shape, np.uint8 ), self.cartoon
+
+        edgeImage = { EDGES[0]: self.adaptive, EDGES[1]: self.canny, EDGES[2]: self.morph }[method]()
+        enhancedImage = cv2.bitwise_and( self.cartoon, self.cartoon, mask = 255 - edgeImage )
+        return edgeImage, enhancedImage
+
+
+# get canny edges in each of the region of interest
+def getCannyEdge( objects, cartoon ):
+    return FrameEdges( objects, cartoon ).canny()
 
 
 # get morphologic edge in each of the region of interest
 def getMorphEdge( objects, cartoon ):
-    # pre-process
-    edges = np.zeros( cartoon.shape[:2], np.uint8 )
-    grey = cv2.cvtColor( cartoon, cv2.COLOR_BGR2GRAY )
-
-    # for each region of interest with score larger than 90%
-    for score, roi in zip( objects['scores'], objects['rois'] ):
-        if( score > 0.9 ):
-            # clip to the region
-            region = grey[ roi[0] : roi[2], roi[1] : roi[3] ]
-
-            # threshold edges
-            _, thresh = cv2.threshold( region, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU )
-
-            # dilated edges
-            kern = np.ones( ( 3, 3 ), np.uint8 )
-            dilate = cv2.dilate( thresh, kern )
-
-            # difference between edges to get actual edges
-            edge = cv2.absdiff( dilate, thresh )
-            
-            # place regional edge to the whole picture
-            edges[ roi[0] : roi[2], roi[1] : roi[3] ] = edge
-
-    return edges
+    return FrameEdges( objects, cartoon ).morph()
 
 
 # get adaptive edge in each of the region of interest
 def getAdaptiveEdge( objects, cartoon ):
-    # pre-process
-    edges = np.zeros( cartoon.shape[:2], np.uint8 )
-    grey = cv2.cvtColor( cartoon, cv2.COLOR_BGR2GRAY )
-
-    # for each region of interest with score larger than 90%
-    for score, roi in zip( objects['scores'], objects['rois'] ):
-        if( score > 0.9 ):
-            # parameters to be tuned
-            area = ( roi[2] - roi[0] ) * ( roi[3] - roi[1] ) 
-            lineSize = max( round( ( ( area ** 0.5 ) / 61.8 - 1 ) / 2 ) * 2 + 1, 3 )    # has to be odd
-            blurSize = 5
-
-            # clip to the region
-            region = grey[ roi[0] : roi[2], roi[1] : roi[3] ]
-            blur = cv2.medianBlur( region, blurSize )
-
-            # threshold edges
-            edge = cv2.adaptiveThreshold( blur, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, lineSize, blurSize )
-            edge = 255 - edge
-            
-            # place regional edge to the whole picture
-            edges[ roi[0] : roi[2], roi[1] : roi[3] ] = edge
-
-    return edges
+    return FrameEdges( objects, cartoon ).adaptive()
 
 
 # get edges and enhanced image base on method
 def getEdge( obj, cartoon, method ):
-    edgeImage, enhancedImage = None, None
+    if method not in EDGES:
+        return None, None
+    return FrameEdges( obj, cartoon ).enhance( method )
 
-    if method == EDGES[0]:
-        edgeImage = getAdaptiveEdge( obj, cartoon )
-        enhancedImage = cv2.bitwise_and( cartoon, cartoon, mask = 255 - edgeImage )
 
-    elif method == EDGES[1]:
-        edgeImage = getCannyEdge( obj, cartoon )
-        enhancedImage = cv2.bitwise_and( cartoon, cartoon, mask = 255 - edgeImage )
+# apply an edge method to BGR cartoon frames with the objects detected in each frame
+def enhanceImages( cartoons, objects, method ):
+    return enhanceAll( cartoons, objects, [ method ] )[method]
 
-    elif method == EDGES[2]:
-        edgeImage = getMorphEdge( obj, cartoon )
-        enhancedImage = cv2.bitwise_and( cartoon, cartoon, mask = 255 - edgeImage )
 
-    elif method == EDGES[3]:
-        edgeImage = np.zeros( cartoon.shape[:2], np.uint8 )
-        enhancedImage = cartoon
+# apply every edge method in a single pass over the frames, see `FrameEdges` for
+# `workers` and `mergeIoU`. returns { method: ( edgeImages, enhancedImages ) }
+def enhanceAll( cartoons, objects, methods, workers = 0, mergeIoU = 0 ):
+    results = { m: ( [], [] ) for m in methods }
+    for cartoon, obj in zip( cartoons, objects ):
+        frame = FrameEdges( obj, cartoon, workers, mergeIoU )
+        for m in methods:
+            edgeImage, enhancedImage = frame.enhance( m )
+            results[m][0].append( edgeImage )
+            results[m][1].append( enhancedImage )
 
-    return edgeImage, enhancedImage
+    return results
 
 
 # enhance objects in cartoon image
@@ -155,6 +263,9 @@ def main( imagePath, outputDir, edges, styles ):
     tempDir = os.path.join( outputDir, '.tmp')
     pngDir = os.path.join( tempDir, os.path.splitext( filename )[0] )
 
+    # objects of every frame are read once and shared by every style and edge
+    objects = loadObjects( os.path.join( pngDir, 'objects.det' ) )
+
     logger.info( f'Generating {edges} edges with {styles} styles...' )
     for style in styles:
         # find cartoon and objects based on image type
@@ -164,26 +275,19 @@ def main( imagePath, outputDir, edges, styles ):
             cartoonPaths.extend( glob.glob( os.path.join( pngDir, style, f"*.png" ) ) )
             cartoonPaths = sorted( cartoonPaths, key=lambda x: int(x.split('/')[-1].replace('.png', '')) )
             num_images = len( cartoonPaths )
-
-            # find objects from temporary folder
-            objPaths = []
-            objPaths.extend( glob.glob( os.path.join( pngDir, "objects", f"*.npy" ) ) )
-            objPaths = sorted( objPaths, key=lambda x: int(x.split('/')[-1].replace('.npy', '')) )
         else:
             # find cartoons from cartoon folder
             cartoonPaths = [ os.path.join( outputDir, style, filename ) ]
 
-            # find objects from temporary folder
-            objPaths = [ os.path.join( pngDir, "objects", "0.npy" ) ]
+        # generate every edge of a frame from a single read of its cartoon
+        logger.debug( f'Generating {edges} edges with {style} style...' )
+        for i, ( cPath, obj ) in enumerate( zip( cartoonPaths, objects ) ):
+            cartoon = cv2.imread( cPath )
+            frame = FrameEdges( obj, cartoon )
 
-        # generate edges 
-        for e in edges:
-            logger.debug( f'Generating {e} edge with {style} style...' )
-            for i, ( cPath, oPath ) in enumerate( zip( cartoonPaths, objPaths ) ):
+            for e in edges:
                 # get edges
-                cartoon = cv2.imread( cPath )
-                obj = np.load( oPath, allow_pickle = True )[()]
-                edgeImage, enhancedImage = getEdge( obj, cartoon, e )
+                edgeImage, enhancedImage = frame.enhance( e )
 
                 # create directory and save edges
                 edgeDir = os.path.join( pngDir, style, e )
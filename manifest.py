@@ -0,0 +1,93 @@
+####################
+# This file records which stages of which inputs a run has finished.
+# A restarted run looks inputs up in the manifest and skips the finished ones.
+
+
+import os
+import sys
+import time
+import sqlite3
+import logging
+import threading
+
+
+# logger
+logger = logging.getLogger("Manifest")
+logger.propagate = False
+log_lvl = {"debug": logging.DEBUG, "info": logging.INFO,
+           "warning": logging.WARNING, "error": logging.ERROR,
+           "critical": logging.CRITICAL}
+logger.setLevel( log_lvl['info'] )
+formatter = logging.Formatter(
+    "[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s", "%Y-%m-%d %H:%M:%S")
+stdhandler = logging.StreamHandler(sys.stdout)
+stdhandler.setFormatter(formatter)
+logger.addHandler(stdhandler)
+
+
+# small SQLite journal of finished stages, shared by threads and forked workers
+class RunManifest( object ):
+    def __init__( self, path ):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.skipped = 0
+        self.savedSeconds = 0.0
+
+        saveDir = os.path.dirname( path )
+        if saveDir and not os.path.exists( saveDir ):
+            os.makedirs( saveDir )
+
+        with self.connect() as db:
+            db.execute( 'CREATE TABLE IF NOT EXISTS stages ('
+                        'path TEXT, key TEXT, stage TEXT, seconds REAL, finished REAL, '
+                        'PRIMARY KEY ( path, key, stage ) )' )
+
+
+    # every thread of every process needs its own connection
+    def connect( self ):
+        if getattr( self.local, 'pid', None ) != os.getpid():
+            self.local.db = sqlite3.connect( self.path, timeout = 60 )
+            self.local.pid = os.getpid()
+        return self.local.db
+
+
+    # remember that `stage` finished for the input at `path` with content `key`
+    def record( self, path, key, stage, seconds ):
+        with self.connect() as db:
+            db.execute( 'INSERT OR REPLACE INTO stages VALUES ( ?, ?, ?, ?, ? )',
+                        ( path, key, stage, seconds, time.time() ) )
+
+
+    # seconds spent on every recorded stage of an input
+    def stages( self, path, key ):
+        rows = self.connect().execute( 'SELECT stage, seconds FROM stages WHERE path = ? AND key = ?',
+                                       ( path, key ) ).fetchall()
+        return dict( rows )
+
+
+    # drop every recorded stage of an input, so that it is processed again
+    def forget( self, path, key ):
+        with self.connect() as db:
+            db.execute( 'DELETE FROM stages WHERE path = ? AND key = ?', ( path, key ) )
+
+
+    # true if `lastStage` finished, which means every earlier stage did as well, and
+    # every file of `outputs` still exists and is not empty. otherwise the input is
+    # forgotten and done again. skipped inputs are counted together with the time they took before
+    def completed( self, path, key, lastStage, outputs = () ):
+        stages = self.stages( path, key )
+        if lastStage not in stages:
+            return False
+
+        missing = [ p for p in outputs if not os.path.exists( p ) or os.path.getsize( p ) == 0 ]
+        if missing:
+            logger.info( f"{path} was finished by a previous run but {missing[0]} is missing, processing it again" )
+            self.forget( path, key )
+            return False
+
+        with self.lock:
+            self.skipped += 1
+            self.savedSeconds += sum( stages.values() )
+        logger.debug( f"{path} was finished by a previous run, skipping it" )
+        return True
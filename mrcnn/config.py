@@ -123,9 +123,14 @@ class Config(object):
     #         on IMAGE_MIN_DIM and IMAGE_MIN_SCALE, then picks a random crop of
     #         size IMAGE_MIN_DIM x IMAGE_MIN_DIM. Can be used in training only.
     #         IMAGE_MAX_DIM is not used in this mode.
+    # bucketed: Like square, but the side of the square is the smallest of
+    #         IMAGE_SQUARE_SIZES that fits the scaled image, so small images
+    #         are not padded up to IMAGE_MAX_DIM. Inference only.
     IMAGE_RESIZE_MODE = "square"
     IMAGE_MIN_DIM = 800
     IMAGE_MAX_DIM = 1024
+    # Square sizes of the bucketed resizing mode, each a multiple of 64
+    IMAGE_SQUARE_SIZES = [256, 384, 512, 640, 768, 1024]
     # Minimum scaling ratio. Checked after MIN_IMAGE_DIM and can force further
     # up scaling. For example, if set to 2 then images are scaled up to double
     # the width and height, or more, even if MIN_IMAGE_DIM doesn't require it.
@@ -174,6 +179,17 @@ class Config(object):
     # Non-maximum suppression threshold for detection
     DETECTION_NMS_THRESHOLD = 0.3
 
+    # Predict instance masks at inference. If disabled, the inference model is
+    # built without the mask head and detect() returns boxes, class IDs and
+    # scores only, which is faster when the masks are not needed.
+    DETECTION_MASKS = True
+
+    # Run inference through a tf.function traced once per molded image shape,
+    # with the anchors of the shape captured as graph constants, instead of
+    # keras_model.predict(), which sets up its data handling and is fed the
+    # anchors on every call. Results are the same, the overhead per call is lower.
+    DETECTION_SERVING = False
+
     # Learning rate and momentum
     # The Mask RCNN paper uses lr=0.02, but on TensorFlow it causes
     # weights to explode. Likely due to differences in optimizer
@@ -2043,18 +2043,25 @@ class MaskRCNN():
             detections = DetectionLayer(config, name="mrcnn_detection")(
                 [rpn_rois, mrcnn_class, mrcnn_bbox, input_image_meta])
 
-            # Create masks for detections
-            detection_boxes = KL.Lambda(lambda x: x[..., :4])(detections)
-            mrcnn_mask = build_fpn_mask_graph(detection_boxes, mrcnn_feature_maps,
-                                              input_image_meta,
-                                              config.MASK_POOL_SIZE,
-                                              config.NUM_CLASSES,
-                                              train_bn=config.TRAIN_BN)
-
-            model = KM.Model([input_image, input_image_meta, input_anchors],
-                             [detections, mrcnn_class, mrcnn_bbox,
-                                 mrcnn_mask, rpn_rois, rpn_class, rpn_bbox],
-                             name='mask_rcnn')
+            # Boxes only, without the mask head
+            if not config.DETECTION_MASKS:
+                model = KM.Model([input_image, input_image_meta, input_anchors],
+                                 [detections, mrcnn_class, mrcnn_bbox,
+                                     rpn_rois, rpn_class, rpn_bbox],
+                                 name='mask_rcnn')
+            else:
+                # Create masks for detections
+                detection_boxes = KL.Lambda(lambda x: x[..., :4])(detections)
+                mrcnn_mask = build_fpn_mask_graph(detection_boxes, mrcnn_feature_maps,
+                                                  input_image_meta,
+                                                  config.MASK_POOL_SIZE,
+                                                  config.NUM_CLASSES,
+                                                  train_bn=config.TRAIN_BN)
+
+                model = KM.Model([input_image, input_image_meta, input_anchors],
+                                 [detections, mrcnn_class, mrcnn_bbox,
+                                     mrcnn_mask, rpn_rois, rpn_class, rpn_bbox],
+                                 name='mask_rcnn')
 
         # Add multi-GPU support.
         if config.GPU_COUNT > 1:
@@ -2409,7 +2416,8 @@ class MaskRCNN():
                 min_dim=self.config.IMAGE_MIN_DIM,
                 min_scale=self.config.IMAGE_MIN_SCALE,
                 max_dim=self.config.IMAGE_MAX_DIM,
-                mode=self.config.IMAGE_RESIZE_MODE)
+                mode=self.config.IMAGE_RESIZE_MODE,
+                square_sizes=self.config.IMAGE_SQUARE_SIZES)
             molded_image = mold_image(molded_image, self.config)
             # Build image_meta
             image_meta = compose_image_meta(
@@ -2432,7 +2440,8 @@ class MaskRCNN():
         application.
 
         detections: [N, (y1, x1, y2, x2, class_id, score)] in normalized coordinates
-        mrcnn_mask: [N, height, width, num_classes]
+        mrcnn_mask: [N, height, width, num_classes], or None if the model
+            predicts boxes only
         original_image_shape: [H, W, C] Original image shape before resizing
         image_shape: [H, W, C] Shape of the image after resizing and padding
         window: [y1, x1, y2, x2] Pixel coordinates of box in the image where the real
@@ -2442,7 +2451,8 @@ class MaskRCNN():
         boxes: [N, (y1, x1, y2, x2)] Bounding boxes in pixels
         class_ids: [N] Integer class IDs for each bounding box
         scores: [N] Float probability scores of the class_id
-        masks: [height, width, num_instances] Instance masks
+        masks: [height, width, num_instances] Instance masks as utils.InstanceMasks,
+            None without mrcnn_mask
         """
         # How many detections do we have?
         # Detections array is padded with zeros. Find the first class_id == 0.
@@ -2453,7 +2463,8 @@ class MaskRCNN():
         boxes = detections[:N, :4]
         class_ids = detections[:N, 4].astype(np.int32)
         scores = detections[:N, 5]
-        masks = mrcnn_mask[np.arange(N), :, :, class_ids]
+        masks = mrcnn_mask[np.arange(N), :, :, class_ids]\
+            if mrcnn_mask is not None else None
 
         # Translate normalized coordinates in the resized image to pixel
         # coordinates in the original image before resizing
@@ -2476,17 +2487,16 @@ class MaskRCNN():
             boxes = np.delete(boxes, exclude_ix, axis=0)
             class_ids = np.delete(class_ids, exclude_ix, axis=0)
             scores = np.delete(scores, exclude_ix, axis=0)
-            masks = np.delete(masks, exclude_ix, axis=0)
+            if masks is not None:
+                masks = np.delete(masks, exclude_ix, axis=0)
             N = class_ids.shape[0]
 
-        # Resize masks to original image size and set boundary threshold.
-        full_masks = []
-        for i in range(N):
-            # Convert neural network mask to full size mask
-            full_mask = utils.unmold_mask(masks[i], boxes[i], original_image_shape)
-            full_masks.append(full_mask)
-        full_masks = np.stack(full_masks, axis=-1)\
-            if full_masks else np.empty(original_image_shape[:2] + (0,))
+        if masks is None:
+            return boxes, class_ids, scores, None
+
+        # Resize masks into their boxes and set boundary threshold. Full size
+        # masks are only built when they are accessed
+        full_masks = utils.InstanceMasks.from_network(masks, boxes, original_image_shape)
 
         return boxes, class_ids, scores, full_masks
 
@@ -2499,7 +2509,8 @@ class MaskRCNN():
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
-        masks: [H, W, N] instance binary masks
+        masks: [H, W, N] instance binary masks as utils.InstanceMasks, unless
+            DETECTION_MASKS is False
         """
         assert self.mode == "inference", "Create model in inference mode."
         assert len(
@@ -2520,25 +2531,13 @@ class MaskRCNN():
             assert g.shape == image_shape,\
                 "After resizing, all images must have the same size. Check IMAGE_RESIZE_MODE and image sizes."
 
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
-        # print("PPPPPPPPPPPP ", image_metas)
-        # print("QQQQQQQQQ ", anchors)
-        # np.save("image_metas.npy", image_metas)
-        # np.save("anchors.npy", anchors)
-        # np.save("molded_images.npy", molded_images)
-
         if verbose:
             log("molded_images", molded_images)
             log("image_metas", image_metas)
-            log("anchors", anchors)
+            log("anchors", self.get_anchors(image_shape))
 
-        # Run object detection
-        detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+        # Run object detection, anchors are added by run_detection()
+        detections, mrcnn_mask = self.run_detection(molded_images, image_metas)
         # Process detections
         results = []
         for i, image in enumerate(images):
@@ -2546,12 +2545,14 @@ class MaskRCNN():
                 self.unmold_detections(detections[i], mrcnn_mask[i],
                                        image.shape, molded_images[i].shape,
                                        windows[i])
-            results.append({
+            result = {
                 "rois": final_rois,
                 "class_ids": final_class_ids,
                 "scores": final_scores,
-                "masks": final_masks,
-            })
+            }
+            if final_masks is not None:
+                result["masks"] = final_masks
+            results.append(result)
         return results
 
     def detect_molded(self, molded_images, image_metas, verbose=0):
@@ -2566,7 +2567,8 @@ class MaskRCNN():
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
-        masks: [H, W, N] instance binary masks
+        masks: [H, W, N] instance binary masks as utils.InstanceMasks, unless
+            DETECTION_MASKS is False
         """
         assert self.mode == "inference", "Create model in inference mode."
         assert len(molded_images) == self.config.BATCH_SIZE,\
@@ -2583,19 +2585,12 @@ class MaskRCNN():
         for g in molded_images[1:]:
             assert g.shape == image_shape, "Images must have the same size"
 
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
-
         if verbose:
             log("molded_images", molded_images)
             log("image_metas", image_metas)
-            log("anchors", anchors)
-        # Run object detection
-        detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+            log("anchors", self.get_anchors(image_shape))
+        # Run object detection, anchors are added by run_detection()
+        detections, mrcnn_mask = self.run_detection(molded_images, image_metas)
         # Process detections
         results = []
         for i, image in enumerate(molded_images):
@@ -2604,14 +2599,75 @@ class MaskRCNN():
                 self.unmold_detections(detections[i], mrcnn_mask[i],
                                        image.shape, molded_images[i].shape,
                                        window)
-            results.append({
+            result = {
                 "rois": final_rois,
                 "class_ids": final_class_ids,
                 "scores": final_scores,
-                "masks": final_masks,
-            })
+            }
+            if final_masks is not None:
+                result["masks"] = final_masks
+            results.append(result)
         return results
 
+    def run_detection(self, molded_images, image_metas):
+        """Runs the inference model on the anchors of the molded image shape
+        and returns detections and masks. Masks are None if the model was
+        built with DETECTION_MASKS disabled.
+        """
+        image_shape = molded_images[0].shape
+        if self.config.DETECTION_SERVING:
+            serving = self.serving_function(image_shape)
+            outputs = serving(np.asarray(molded_images, np.float32),
+                              np.asarray(image_metas, np.float32))
+            outputs = [o.numpy() for o in outputs]
+        else:
+            # Duplicate across the batch dimension because Keras requires it
+            anchors = self.get_anchors(image_shape)
+            anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
+            outputs = self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+        if not self.config.DETECTION_MASKS:
+            return outputs[0], [None] * len(molded_images)
+        return outputs[0], outputs[3]
+
+    def serving_function(self, image_shape):
+        """Returns a tf.function running the inference model on a batch of
+        molded images of the given shape and their image metas.
+
+        It has a fixed input signature, so it is traced once per molded
+        shape and reused afterwards, and the anchors of the shape are
+        captured as constants of the traced graph instead of being fed on
+        every call like keras_model.predict() needs them.
+        """
+        if not hasattr(self, "_serving_functions"):
+            self._serving_functions = {}
+        key = tuple(image_shape)
+        if key not in self._serving_functions:
+            anchors = self.get_batch_anchors(image_shape)
+            signature = [
+                tf.TensorSpec([self.config.BATCH_SIZE] + list(image_shape), tf.float32),
+                tf.TensorSpec([self.config.BATCH_SIZE, self.config.IMAGE_META_SIZE], tf.float32),
+            ]
+            model = self.keras_model
+
+            def serve(molded_images, image_metas):
+                return model([molded_images, image_metas, tf.constant(anchors)])
+
+            self._serving_functions[key] = tf.function(serve, input_signature=signature)
+        return self._serving_functions[key]
+
+    def get_batch_anchors(self, image_shape):
+        """Returns the anchors of a molded image shape broadcast across the
+        batch, cached per shape.
+        """
+        if not hasattr(self, "_batch_anchor_cache"):
+            self._batch_anchor_cache = {}
+        key = tuple(image_shape)
+        if key not in self._batch_anchor_cache:
+            anchors = self.get_anchors(image_shape)
+            self._batch_anchor_cache[key] = np.ascontiguousarray(
+                np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape))
+        return self._batch_anchor_cache[key]
+
     def get_anchors(self, image_shape):
         """Returns anchor pyramid for the given image size."""
         backbone_shapes = compute_backbone_shapes(self.config, image_shape)
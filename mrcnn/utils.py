@@ -14,6 +14,7 @@ import math
 import random
 import numpy as np
 import tensorflow as tf
+import cv2
 import scipy
 import skimage.color
 import skimage.io
@@ -385,7 +386,8 @@ class Dataset(object):
         return mask, class_ids
 
 
-def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square"):
+def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square",
+                 square_sizes=None):
     """Resizes an image keeping the aspect ratio unchanged.
 
     min_dim: if provided, resizes the image such that it's smaller
@@ -403,6 +405,8 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
                before padding. max_dim is ignored in this mode.
                The multiple of 64 is needed to ensure smooth scaling of feature
                maps up and down the 6 levels of the FPN pyramid (2**6=64).
+        bucketed: Like square, but pads to the smallest of square_sizes that
+               fits the scaled image, or to max_dim if none does.
         crop: Picks random crops from the image. First, scales the image based
               on min_dim and min_scale, then picks a random crop of
               size min_dim x min_dim. Can be used in training only.
@@ -436,6 +440,13 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
     if min_scale and scale < min_scale:
         scale = min_scale
 
+    # Smallest square that fits the image
+    if mode == "bucketed":
+        image_max = round(max(h, w) * scale)
+        fitting = [d for d in square_sizes or [] if d >= image_max]
+        max_dim = min(fitting) if fitting else max_dim
+        mode = "square"
+
     # Does it exceed max dim?
     if max_dim and mode == "square":
         image_max = max(h, w)
@@ -461,7 +472,7 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
     elif mode == "pad64":
         h, w = image.shape[:2]
         # Both sides must be divisible by 64
-        assert min_dim % 64 == 0, "Minimum dimension must be a multiple of 64"
+        assert not min_dim or min_dim % 64 == 0, "Minimum dimension must be a multiple of 64"
         # Height
         if h % 64 > 0:
             max_h = h - (h % 64) + 64
@@ -576,6 +587,129 @@ def unmold_mask(mask, bbox, image_shape):
     return full_mask
 
 
+class InstanceMasks(object):
+    """Binary instance masks stored only within their bounding boxes.
+
+    Stands in for the [height, width, num_instances] boolean array of full
+    size masks: shape, len(), masks[:, :, i], np.asarray(masks), astype()
+    and comparisons such as masks > 0.5 behave the same, but full size masks
+    are only allocated when they are accessed.
+    Memory and time therefore scale with the area of the objects rather than
+    the image area times the number of instances.
+
+    crops: list of [y2 - y1, x2 - x1] boolean masks, one per box
+    boxes: [N, (y1, x1, y2, x2)] in pixels of the original image
+    image_shape: [H, W, ...] of the original image
+    """
+
+    def __init__(self, crops, boxes, image_shape):
+        self.crops = list(crops)
+        self.boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+        self.image_shape = tuple(image_shape[:2])
+        self.dtype = np.dtype(bool)
+        self.ndim = 3
+
+    @classmethod
+    def from_network(cls, masks, boxes, image_shape, threshold=0.5):
+        """Resizes the small masks of the network into their boxes with
+        OpenCV, like unmold_mask() but without pasting them into full frames.
+        masks: [N, height, width] of type float, typically 28x28
+        """
+        crops = []
+        for mask, (y1, x1, y2, x2) in zip(masks, boxes):
+            h, w = max(y2 - y1, 0), max(x2 - x1, 0)
+            if h == 0 or w == 0:
+                crops.append(np.zeros((h, w), dtype=bool))
+                continue
+            crop = cv2.resize(mask.astype(np.float32), (w, h), interpolation=cv2.INTER_LINEAR)
+            crops.append(crop >= threshold)
+        return cls(crops, boxes, image_shape)
+
+    @property
+    def shape(self):
+        return self.image_shape + (len(self.crops),)
+
+    def __len__(self):
+        return len(self.crops)
+
+    def mask(self, i):
+        """Full size boolean mask of instance i."""
+        y1, x1, y2, x2 = self.boxes[i]
+        full_mask = np.zeros(self.image_shape, dtype=bool)
+        full_mask[y1:y2, x1:x2] = self.crops[i]
+        return full_mask
+
+    def __array__(self, dtype=None):
+        full_masks = np.zeros(self.shape, dtype=bool)
+        for i, (y1, x1, y2, x2) in enumerate(self.boxes):
+            full_masks[y1:y2, x1:x2, i] = self.crops[i]
+        return full_masks if dtype is None else full_masks.astype(dtype)
+
+    def __getitem__(self, key):
+        # masks[:, :, i] and masks[..., i] only build the requested mask
+        if isinstance(key, tuple) and isinstance(key[-1], (int, np.integer)):
+            if key[:-1] in ((slice(None), slice(None)), (Ellipsis,)):
+                return self.mask(key[-1])
+        return np.asarray(self)[key]
+
+    def astype(self, dtype):
+        """Full size masks as a dense array of the given type."""
+        return np.asarray(self, dtype=dtype)
+
+    # Comparisons expand to the dense array, like those of a boolean ndarray
+    def __eq__(self, other):
+        return np.asarray(self) == other
+
+    def __ne__(self, other):
+        return np.asarray(self) != other
+
+    def __lt__(self, other):
+        return np.asarray(self) < other
+
+    def __le__(self, other):
+        return np.asarray(self) <= other
+
+    def __gt__(self, other):
+        return np.asarray(self) > other
+
+    def __ge__(self, other):
+        return np.asarray(self) >= other
+
+    # Defining __eq__ removes the default hash, arrays are not hashable either
+    __hash__ = None
+
+    def areas(self):
+        """Number of pixels of every instance."""
+        return np.array([c.sum() for c in self.crops], dtype=np.int64)
+
+    def to_rle(self):
+        """Run-length encodes every crop in row-major order. Runs alternate
+        between False and True and start with False, so the first run may be
+        empty. Returns a list of int32 arrays, one per instance.
+        """
+        rles = []
+        for crop in self.crops:
+            flat = crop.ravel()
+            changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+            edges = np.concatenate([[0], changes, [flat.size]])
+            runs = np.diff(edges)
+            if flat.size and flat[0]:
+                runs = np.concatenate([[0], runs])
+            rles.append(runs.astype(np.int32))
+        return rles
+
+    @classmethod
+    def from_rle(cls, rles, boxes, image_shape):
+        """Inverse of to_rle()."""
+        boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+        crops = []
+        for runs, (y1, x1, y2, x2) in zip(rles, boxes):
+            values = np.arange(len(runs)) % 2 == 1
+            crop = np.repeat(values, runs)
+            crops.append(crop.reshape(max(y2 - y1, 0), max(x2 - x1, 0)))
+        return cls(crops, boxes, image_shape)
+
+
 ############################################################
 #  Anchors
 ############################################################
@@ -0,0 +1,926 @@
+####################
+# This file connects detection, cartoonization and edge enhancement in memory.
+# Decoded images and detection results are handed from stage to stage directly,
+# only the final results are written to the output directory.
+
+
+import os
+import sys
+import PIL
+import time
+import hashlib
+import queue
+import imageio
+import logging
+import threading
+import multiprocessing
+import numpy as np
+import tensorflow as tf
+import cartoonize
+import detect
+import enhance
+import encoder
+from cache import makeKey
+from cache import inputKey
+from cache import packObjects
+from cache import unpackObjects
+from cache import ResultCache
+from manifest import RunManifest
+from cartoongan.cartoongan import MODEL_VERSION as CARTOON_MODEL_VERSION
+from concurrent.futures import ThreadPoolExecutor
+
+
+# logger
+logger = logging.getLogger("Pipeline")
+logger.propagate = False
+log_lvl = {"debug": logging.DEBUG, "info": logging.INFO,
+           "warning": logging.WARNING, "error": logging.ERROR,
+           "critical": logging.CRITICAL}
+logger.setLevel( log_lvl['info'] )
+formatter = logging.Formatter(
+    "[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s", "%Y-%m-%d %H:%M:%S")
+stdhandler = logging.StreamHandler(sys.stdout)
+stdhandler.setFormatter(formatter)
+logger.addHandler(stdhandler)
+
+# passed down the stage queues once every input has been queued
+STOP = None
+
+# inputs decoded with imageio's streaming video reader
+VIDEO_EXTENSIONS = ['mp4', 'mov', 'avi', 'mkv', 'webm']
+
+
+def isVideo( path ):
+    return os.path.splitext( path )[1][1:].lower() in VIDEO_EXTENSIONS
+
+
+# split TensorFlow's thread pools between concurrently running models, 0 keeps the default.
+# it has to be called before the first model is built
+def configureThreads( intraOp = 0, interOp = 0 ):
+    try:
+        if intraOp:
+            tf.config.threading.set_intra_op_parallelism_threads( intraOp )
+        if interOp:
+            tf.config.threading.set_inter_op_parallelism_threads( interOp )
+    except RuntimeError:
+        logger.warning( "TensorFlow is already initialized, thread settings are ignored" )
+    return
+
+
+# perceptual hash of a frame, comparing neighboring pixels of a 9x8 grey thumbnail
+def dHash( frame ):
+    thumbnail = np.asarray( PIL.Image.fromarray( frame ).convert( 'L' ).resize( ( 9, 8 ), PIL.Image.BILINEAR ), np.int16 )
+    bits = thumbnail[:, 1:] > thumbnail[:, :-1]
+    return int.from_bytes( np.packbits( bits ).tobytes(), 'big' )
+
+
+# drop repeated frames. `mode` is `exact` for identical frames or `perceptual` for frames whose
+# hashes differ by at most `distance` bits. returns the unique frames and, for every frame,
+# the index of the unique frame standing in for it
+def dedupFrames( frames, mode = 'exact', distance = 0 ):
+    unique, index = [], []
+    exact, perceptual = {}, []
+    for frame in frames:
+        key = hashlib.sha1( frame.tobytes() ).digest() + str( frame.shape ).encode()
+        i = exact.get( key )
+        if i is None and mode == 'perceptual':
+            h = dHash( frame )
+            i = next( ( j for j, other in perceptual if bin( h ^ other ).count( '1' ) <= distance ), None )
+        if i is None:
+            i = len( unique )
+            unique.append( frame )
+            exact[key] = i
+            if mode == 'perceptual':
+                perceptual.append( ( i, h ) )
+        index.append( i )
+
+    return unique, index
+
+
+# state of one input image (or gif) while it moves through the pipeline
+class Job( object ):
+    def __init__( self, path ):
+        self.path = path
+        self.filename = path.split( os.path.sep )[-1]
+        self.name = os.path.splitext( self.filename )[0]
+        self.isGif = self.filename.endswith( '.gif' )
+        self.isVideo = isVideo( path )
+        self.key = None         # content hash of the input and its preprocessing
+        self.cacheable = True   # results go to the result cache, video chunks bypass it
+
+        self.frames = []        # RGB input frames, without repeated frames
+        self.frameIndex = None  # unique frame of every decoded frame, None if none was dropped
+        self.objects = []       # detection result of each frame
+        self.cartoons = {}      # style -> RGB cartoon frames
+        self.enhanced = {}      # ( style, edge ) -> RGB enhanced frames
+
+        self.error = None       # exception raised by a stage, later stages skip the job
+        self.skipped = False    # finished by a previous run
+        self.started = None
+        self.latency = None
+
+    # frames of a stage in the order of the input, repeating those of dropped frames
+    def expand( self, frames ):
+        if self.frameIndex is None:
+            return frames
+        return [ frames[i] for i in self.frameIndex ]
+
+    # drop decoded arrays once the results are written
+    def release( self ):
+        self.frames = []
+        self.objects = []
+        self.cartoons = {}
+        self.enhanced = {}
+
+
+# runs every stage of our method on one input at a time
+class Pipeline( object ):
+    def __init__( self, args ):
+        self.args = args
+        self.executor = None
+
+        # previously computed results are looked up by content
+        self.cache = None
+        if not args.no_cache:
+            self.cache = ResultCache( args.cache_dir or os.path.join( args.output_dir, '.cache' ), args.cache_mb )
+
+        # finished stages are journaled so that an interrupted run can resume
+        self.manifest = None
+        if not args.no_manifest:
+            self.manifest = RunManifest( os.path.join( args.output_dir, 'manifest.sqlite' ) )
+
+        # edge enhancement only reads boxes, the mask head can be left out.
+        # the molding profile decides how much Mask R-CNN upsamples small inputs
+        self.detectorConfig = detect.makeConfig( masks = not args.boxes_only, profile = args.detect_profile,
+                                                  batchSize = args.detect_batch, serving = args.detect_serving )
+
+        # decoded gif frames, and how many of them repeated an earlier one.
+        # frames whose objects were detected, and how many of them ran the detector
+        self.decodedFrames = 0
+        self.droppedFrames = 0
+        self.detectedFrames = 0
+        self.detectorCalls = 0
+        self.statsLock = threading.Lock()
+
+        # stage modules read their settings from the shared arguments
+        cartoonize.handle_args( args )
+
+        # detection and every style share the TF runtime on a small thread pool
+        self.startExecutor()
+
+
+    # counters reported at the end of a run, as a flat dict of numbers
+    def counters( self ):
+        counters = {
+            'decodedFrames': self.decodedFrames,
+            'droppedFrames': self.droppedFrames,
+            'detectedFrames': self.detectedFrames,
+            'detectorCalls': self.detectorCalls,
+            'modelHits': cartoonize.MODEL_CACHE.hits,
+            'modelMisses': cartoonize.MODEL_CACHE.misses,
+            'modelEvictions': cartoonize.MODEL_CACHE.evictions,
+            'traces': cartoonize.TRACE_STATS['traces'],
+            'traceCalls': cartoonize.TRACE_STATS['calls'],
+        }
+        if self.cache is not None:
+            for kind, ( hits, misses ) in self.cache.stats().items():
+                counters[f'{kind}Hits'] = hits
+                counters[f'{kind}Misses'] = misses
+            counters['cacheEvictions'] = self.cache.evictions
+        return counters
+
+
+    # add counters of another process, as returned by `counters`
+    def mergeCounters( self, counters ):
+        with self.statsLock:
+            self.decodedFrames += counters.get( 'decodedFrames', 0 )
+            self.droppedFrames += counters.get( 'droppedFrames', 0 )
+            self.detectedFrames += counters.get( 'detectedFrames', 0 )
+            self.detectorCalls += counters.get( 'detectorCalls', 0 )
+
+        modelCache = cartoonize.MODEL_CACHE
+        with modelCache.lock:
+            modelCache.hits += counters.get( 'modelHits', 0 )
+            modelCache.misses += counters.get( 'modelMisses', 0 )
+            modelCache.evictions += counters.get( 'modelEvictions', 0 )
+        with cartoonize.TRACE_LOCK:
+            cartoonize.TRACE_STATS['traces'] += counters.get( 'traces', 0 )
+            cartoonize.TRACE_STATS['calls'] += counters.get( 'traceCalls', 0 )
+
+        if self.cache is not None:
+            with self.cache.lock:
+                for kind in self.cache.hits:
+                    self.cache.hits[kind] += counters.get( f'{kind}Hits', 0 )
+                    self.cache.misses[kind] += counters.get( f'{kind}Misses', 0 )
+                self.cache.evictions += counters.get( 'cacheEvictions', 0 )
+        return
+
+
+    def startExecutor( self ):
+        if self.args.concurrent_stages or self.args.concurrent_styles:
+            self.executor = ThreadPoolExecutor( max_workers = 1 + len( self.args.styles ) )
+
+
+    # shrink an image to the configured height, keeping its aspect ratio
+    def resize( self, image ):
+        if self.args.keep_original_size:
+            return image
+
+        width, height = image.size
+        aspect_ratio = width / height
+        resized_height = min( height, self.args.max_resized_height )
+        resized_width = int( resized_height * aspect_ratio )
+        if width != resized_width:
+            logger.debug( f"resized ({width}, {height}) to: ({resized_width}, {resized_height})" )
+            image = image.resize( ( resized_width, resized_height ) )
+
+        return image
+
+
+    # look a result up in the cache, `--overwrite` always recomputes.
+    # results without a key are never cached
+    def cached( self, kind, key ):
+        if self.cache is None or key is None or self.args.overwrite:
+            return None
+        return self.cache.load( kind, key )
+
+
+    def store( self, kind, key, arrays ):
+        if self.cache is not None and key is not None:
+            self.cache.save( kind, key, arrays )
+
+
+    # whether results of `kind` of the job are looked up in and stored to the cache.
+    # enhanced frames are copies of the outputs and only cached with `--cache_enhanced`
+    def usesCache( self, job, kind ):
+        if kind == 'enhanced' and not self.args.cache_enhanced:
+            return False
+        return self.cache is not None and job.cacheable
+
+
+    def detectionKey( self, job ):
+        key = makeKey( job.key, detect.modelVersion( self.detectorConfig ) )
+        if self.usesKeyframes( job ):
+            key = makeKey( key, self.args.keyframe_interval, self.args.scene_threshold )
+        return key
+
+
+    # gif and video frames are detected on keyframes only when `keyframe_interval` is above 1
+    def usesKeyframes( self, job ):
+        return ( job.isGif or job.isVideo ) and self.args.keyframe_interval > 1
+
+
+    def cartoonKey( self, job, style ):
+        a = self.args
+        return makeKey( job.key, style, CARTOON_MODEL_VERSION, a.cartoon_bucket, a.tile_size, a.tile_overlap,
+                        a.trace_bucket )
+
+
+    def enhancedKey( self, job, style, edge ):
+        return makeKey( self.cartoonKey( job, style ), self.detectionKey( job ), edge, self.args.roi_merge_iou )
+
+
+    # key of a job in the manifest, covering every option that changes what is written.
+    # it is built from the keys of every result written and the options of the encoders
+    def runKey( self, job ):
+        a = self.args
+        keys = [ self.detectionKey( job ) ]
+        keys += [ self.cartoonKey( job, style ) for style in a.styles ]
+        keys += [ self.enhancedKey( job, style, edge ) for style in a.styles for edge in a.edges ]
+        chunk = a.video_chunk if job.isVideo else None
+        return makeKey( *keys, a.skip_comparison, a.comparison_view, a.convert_gif_to_mp4, a.gif_palette, chunk )
+
+
+    # every file written for a job
+    def outputPaths( self, job ):
+        outputDir = self.args.output_dir
+        filename = f'{job.name}.mp4' if job.isVideo else job.filename
+        paths = []
+        for style in self.args.styles:
+            paths.append( os.path.join( outputDir, style, filename ) )
+            paths.extend( os.path.join( outputDir, style, edge, filename ) for edge in self.args.edges )
+        if not self.args.skip_comparison:
+            paths.append( os.path.join( outputDir, 'comparison', filename ) )
+        if job.isGif and self.args.convert_gif_to_mp4:
+            paths.extend( [ encoder.mp4Path( p ) for p in paths ] )
+        return paths
+
+
+    # true if a previous run wrote every output of the job and they still exist
+    def finished( self, job ):
+        if self.manifest is None or self.args.overwrite:
+            return False
+        return self.manifest.completed( job.path, self.runKey( job ), 'write', self.outputPaths( job ) )
+
+
+    # decode the input into resized RGB frames
+    def decode( self, job ):
+        job.key = inputKey( job.path, self.args )
+
+        # inputs written completely by a previous run are not processed again
+        if self.finished( job ):
+            job.skipped = True
+            return job
+
+        image = PIL.Image.open( job.path )
+
+        # a still image has a single frame
+        if not job.isGif:
+            job.frames = [ np.asarray( self.resize( image.convert( 'RGB' ) ) ) ]
+            return job
+
+        # extract every `gif_frame_frequency`-th frame of a gif
+        i = 0
+        try:
+            while len( job.frames ) < self.args.max_num_frames:
+                if i % self.args.gif_frame_frequency == 0:
+                    extracted_image = PIL.Image.new( 'RGBA', image.size )
+                    extracted_image.paste( image )
+                    extracted_image = self.resize( extracted_image.convert( 'RGB' ) )
+                    job.frames.append( np.asarray( extracted_image ) )
+
+                image.seek( image.tell() + 1 )
+                i += 1
+
+        except EOFError:
+            pass  # end of sequence
+
+        logger.debug( f"Extracted {len(job.frames)} frames from {job.filename}." )
+
+        self.dedup( job )
+        return job
+
+
+    # later stages only see unique frames, `write` repeats their results
+    def dedup( self, job ):
+        if self.args.dedup == 'none':
+            return
+
+        unique, index = dedupFrames( job.frames, self.args.dedup, self.args.dedup_distance )
+        with self.statsLock:
+            self.decodedFrames += len( job.frames )
+            self.droppedFrames += len( job.frames ) - len( unique )
+        if len( unique ) < len( job.frames ):
+            logger.debug( f"Dropped {len(job.frames) - len(unique)} repeated frames of {job.filename}." )
+            job.frames, job.frameIndex = unique, index
+
+
+    # detect objects in every frame of the jobs
+    def detect( self, jobs ):
+        for job, objects in zip( jobs, self.detectFrames( jobs ) ):
+            job.objects = objects
+        return jobs
+
+
+    # detection results of every job. frames of jobs without keyframes are pooled,
+    # so images of different inputs share the batches of the detector
+    def detectFrames( self, jobs ):
+        results = [ None ] * len( jobs )
+        pooled = []
+        for i, job in enumerate( jobs ):
+            key = self.detectionKey( job ) if self.usesCache( job, 'objects' ) else None
+            cached = self.cached( 'objects', key )
+            if cached is not None:
+                results[i] = unpackObjects( cached )
+            elif self.usesKeyframes( job ):
+                results[i] = self.detectKeyframes( job )
+            else:
+                pooled.append( i )
+
+        if pooled:
+            model = detect.getModel( self.detectorConfig )
+            objects = detect.detectImages( [ f for i in pooled for f in jobs[i].frames ], model )
+            start = 0
+            for i in pooled:
+                results[i] = objects[start:start + len( jobs[i].frames )]
+                start += len( results[i] )
+                self.detected( jobs[i], results[i], len( results[i] ) )
+        return results
+
+
+    def detectKeyframes( self, job ):
+        model = detect.getModel( self.detectorConfig )
+        objects, keyframes = detect.detectKeyframes( job.frames, model, self.args.keyframe_interval,
+                                                     self.args.scene_threshold )
+        self.detected( job, objects, len( keyframes ) )
+        return objects
+
+
+    # count and cache the objects detected in the frames of a job with `calls` detector calls
+    def detected( self, job, objects, calls ):
+        with self.statsLock:
+            self.detectedFrames += len( job.frames )
+            self.detectorCalls += calls
+
+        if self.usesCache( job, 'objects' ):
+            self.store( 'objects', self.detectionKey( job ), packObjects( objects ) )
+        return
+
+
+    # cartoonize every frame of the jobs with every requested style
+    def cartoonize( self, jobs ):
+        tasks = self.cartoonTasks( jobs )
+        if self.executor is not None and self.args.concurrent_styles:
+            futures = [ self.executor.submit( self.cartoonizeStyle, *t ) for t in tasks ]
+            for future in futures:
+                future.result()
+        else:
+            for t in tasks:
+                self.cartoonizeStyle( *t )
+        return jobs
+
+
+    # jobs without a cached cartoon of `style`, cached cartoons are filled in
+    def pendingCartoons( self, jobs, style ):
+        pending = []
+        for job in jobs:
+            key = self.cartoonKey( job, style ) if self.usesCache( job, 'cartoons' ) else None
+            cached = self.cached( 'cartoons', key )
+            if cached is not None:
+                job.cartoons[style] = list( cached['frames'] )
+            else:
+                pending.append( job )
+        return pending
+
+
+    # model input of every frame of the jobs, frames of all jobs share batches
+    def prepareCartoons( self, pending ):
+        frames = [ f for job in pending for f in job.frames ]
+        return cartoonize.prepare_images( frames, bucket = self.args.cartoon_bucket )
+
+
+    # ( pending, style, prepared ) for every style with work left.
+    # styles missing the same jobs share a single preprocessed input
+    def cartoonTasks( self, jobs ):
+        tasks = []
+        prepared = {}
+        for style in self.args.styles:
+            pending = self.pendingCartoons( jobs, style )
+            if not pending:
+                continue
+            ids = tuple( id( job ) for job in pending )
+            if ids not in prepared:
+                prepared[ids] = self.prepareCartoons( pending )
+            tasks.append( ( pending, style, prepared[ids] ) )
+        return tasks
+
+
+    # run one style model on prepared input and hand the cartoons back to their jobs
+    def cartoonizeStyle( self, pending, style, prepared ):
+        model = cartoonize.get_model( style )
+        cartoons = cartoonize.transform_prepared( prepared, model )
+
+        start = 0
+        for job in pending:
+            job.cartoons[style] = cartoons[start:start + len( job.frames )]
+            start += len( job.frames )
+            if self.usesCache( job, 'cartoons' ):
+                self.store( 'cartoons', self.cartoonKey( job, style ), { 'frames': np.stack( job.cartoons[style] ) } )
+        return pending
+
+
+    # run detection and every style concurrently, they only depend on the decoded frames.
+    # the styles' input is prepared here while detection is already running
+    def analyze( self, jobs ):
+        objects = self.executor.submit( self.detect, jobs )
+        cartoons = [ self.executor.submit( self.cartoonizeStyle, *t ) for t in self.cartoonTasks( jobs ) ]
+
+        objects.result()
+        for future in cartoons:
+            future.result()
+        return jobs
+
+
+    # enhance the objects of every cartoon with every requested edge method.
+    # all edges that are not cached are computed in a single pass over the frames
+    def enhance( self, job ):
+        for style in self.args.styles:
+            pending = []
+            for edge in self.args.edges:
+                key = self.enhancedKey( job, style, edge ) if self.usesCache( job, 'enhanced' ) else None
+                cached = self.cached( 'enhanced', key )
+                if cached is not None:
+                    job.enhanced[( style, edge )] = list( cached['frames'] )
+                else:
+                    pending.append( edge )
+
+            if not pending:
+                continue
+
+            # edge methods work on BGR images
+            cartoons = [ np.ascontiguousarray( c[:, :, ::-1] ) for c in job.cartoons[style] ]
+            results = enhance.enhanceAll( cartoons, job.objects, pending,
+                                          self.args.roi_workers, self.args.roi_merge_iou )
+            for edge in pending:
+                _, enhanced = results[edge]
+                job.enhanced[( style, edge )] = [ np.ascontiguousarray( e[:, :, ::-1] ) for e in enhanced ]
+                if self.usesCache( job, 'enhanced' ):
+                    self.store( 'enhanced', self.enhancedKey( job, style, edge ),
+                                { 'frames': np.stack( job.enhanced[( style, edge )] ) } )
+        return job
+
+
+    # write the requested results to the output directory
+    def write( self, job ):
+        outputDir = self.args.output_dir
+
+        for style in self.args.styles:
+            self.save( job.expand( job.cartoons[style] ), os.path.join( outputDir, style, job.filename ) )
+            for edge in self.args.edges:
+                self.save( job.expand( job.enhanced[( style, edge )] ),
+                           os.path.join( outputDir, style, edge, job.filename ) )
+
+        if not self.args.skip_comparison:
+            self.save( self.comparisons( job ), os.path.join( outputDir, 'comparison', job.filename ) )
+
+        return job
+
+
+    # input frames next to their cartoons of every style, in the order of the input
+    def comparisons( self, job ):
+        comparisons = []
+        for i, frame in enumerate( job.frames ):
+            images = [ frame ] + [ job.cartoons[s][i] for s in self.args.styles ]
+            images = [ PIL.Image.fromarray( im ) for im in images ]
+            comparisons.append( np.asarray( cartoonize.concatenate_images( images ) ) )
+        return job.expand( comparisons )
+
+
+    # save frames as an image, or as a gif when there are several of them.
+    # the file is written under a temporary name first, so an interrupted run never
+    # leaves a truncated result behind. the mp4 of a gif is encoded from the same frames
+    def save( self, frames, path ):
+        if path.endswith( '.gif' ):
+            logger.debug( f"Combining {len(frames)} frames into {path}..." )
+            mp4 = encoder.mp4Path( path ) if self.args.convert_gif_to_mp4 else None
+            with encoder.FrameEncoder( path, mp4, gifPalette = self.args.gif_palette,
+                                       workers = self.args.gif_workers ) as output:
+                for frame in frames:
+                    output.append( frame )
+            return path
+
+        saveDir = os.path.dirname( path )
+        if not os.path.exists( saveDir ):
+            os.makedirs( saveDir, exist_ok = True )
+        tmpPath = os.path.join( saveDir, f'.{os.getpid()}.{threading.get_ident()}.{os.path.basename( path )}' )
+        PIL.Image.fromarray( frames[0] ).save( tmpPath )
+        os.replace( tmpPath, path )
+        return path
+
+
+    # stages in the order they are applied, as ( name, stage, batched ).
+    # batched stages take a list of jobs, the others a single job
+    def stages( self ):
+        if self.args.concurrent_stages:
+            return [ ( 'decode', self.decode, False ), ( 'analyze', self.analyze, True ),
+                     ( 'enhance', self.enhance, False ), ( 'write', self.write, False ) ]
+        return [ ( 'decode', self.decode, False ), ( 'detect', self.detect, True ),
+                 ( 'cartoonize', self.cartoonize, True ), ( 'enhance', self.enhance, False ),
+                 ( 'write', self.write, False ) ]
+
+
+    # most jobs a batched stage takes at once, detection batches images by `detect_batch`
+    def batchLimit( self, name ):
+        if name == 'detect':
+            return self.args.detect_batch
+        return self.args.batch_size
+
+
+    # apply one stage to the jobs which are still alive and journal it per job
+    def apply( self, name, stage, jobs, batched = False ):
+        jobs = [ j for j in jobs if j.error is None and not j.skipped ]
+        if not jobs:
+            return
+
+        if batched:
+            start = time.perf_counter()
+            stage( jobs )
+            elapsed = [ ( time.perf_counter() - start ) / len( jobs ) ] * len( jobs )
+        else:
+            elapsed = []
+            for job in jobs:
+                start = time.perf_counter()
+                stage( job )
+                elapsed.append( time.perf_counter() - start )
+
+        if self.manifest is not None:
+            for job, seconds in zip( jobs, elapsed ):
+                if not job.skipped:
+                    self.manifest.record( job.path, self.runKey( job ), name, seconds )
+        return
+
+
+    # run every stage on several inputs at once and return their finished jobs.
+    # videos are streamed through the stages one after another
+    def runMany( self, paths ):
+        jobs = [ Job( path ) for path in paths if not isVideo( path ) ]
+        start = time.perf_counter()
+        for job in jobs:
+            job.started = start
+        for name, stage, batched in self.stages():
+            self.apply( name, stage, jobs, batched )
+        for job in jobs:
+            job.latency = time.perf_counter() - job.started
+        return jobs + [ self.runVideo( path ) for path in paths if isVideo( path ) ]
+
+
+    # decode a video `video_chunk` frames at a time, run the stages between decoding and
+    # writing on every chunk and append the results to the output videos, so memory and
+    # disk use do not grow with the length of the clip. chunks bypass the result cache
+    def runVideo( self, path ):
+        job = Job( path )
+        job.started = time.perf_counter()
+        job.key = inputKey( path, self.args )
+        if self.finished( job ):
+            job.skipped = True
+            return job
+
+        stages = self.stages()[1:-1]
+        reader = imageio.get_reader( path )
+        fps = reader.get_meta_data().get( 'fps', 25 ) / self.args.gif_frame_frequency
+        outputs = {}
+        try:
+            for i, frames in enumerate( self.videoChunks( reader ) ):
+                chunk = Job( path )
+                chunk.key = makeKey( job.key, self.args.video_chunk, i )
+                chunk.cacheable = False
+                chunk.frames = frames
+                self.dedup( chunk )
+
+                for _, stage, batched in stages:
+                    if batched:
+                        stage( [ chunk ] )
+                    else:
+                        stage( chunk )
+                self.appendVideo( outputs, chunk, fps )
+                chunk.release()
+
+            for output in outputs.values():
+                output.close()
+        except Exception as e:
+            logger.exception( f"Failed to transform {job.filename}" )
+            job.error = e
+            for output in outputs.values():
+                output.abort()
+        finally:
+            reader.close()
+
+        job.latency = time.perf_counter() - job.started
+        if self.manifest is not None and job.error is None:
+            self.manifest.record( job.path, self.runKey( job ), 'write', job.latency )
+        return job
+
+
+    # resized RGB frames of a video in chunks of `video_chunk`, keeping every `gif_frame_frequency`-th
+    def videoChunks( self, reader ):
+        frames = []
+        for i, frame in enumerate( reader ):
+            if i % self.args.gif_frame_frequency:
+                continue
+            frames.append( np.asarray( self.resize( PIL.Image.fromarray( frame ).convert( 'RGB' ) ) ) )
+            if len( frames ) == self.args.video_chunk:
+                yield frames
+                frames = []
+        if frames:
+            yield frames
+
+
+    # append the results of a chunk to the output videos, opening them on the first chunk.
+    # videos are written under a temporary name until the last chunk is appended
+    def appendVideo( self, outputs, chunk, fps ):
+        outputDir = self.args.output_dir
+        filename = f'{chunk.name}.mp4'
+        results = []
+        for style in self.args.styles:
+            results.append( ( os.path.join( outputDir, style, filename ), chunk.expand( chunk.cartoons[style] ) ) )
+            for edge in self.args.edges:
+                results.append( ( os.path.join( outputDir, style, edge, filename ),
+                                  chunk.expand( chunk.enhanced[( style, edge )] ) ) )
+        if not self.args.skip_comparison:
+            results.append( ( os.path.join( outputDir, 'comparison', filename ), self.comparisons( chunk ) ) )
+
+        for path, frames in results:
+            if path not in outputs:
+                outputs[path] = encoder.FrameEncoder( mp4Path = path, fps = fps )
+            for frame in frames:
+                outputs[path].append( frame )
+        return
+
+
+    # run every stage on one input and return its finished job
+    def run( self, path ):
+        return self.runMany( [ path ] )[0]
+
+
+# runs every stage on a dedicated worker thread so that consecutive inputs overlap,
+# bounded queues between the stages keep fast stages from running ahead
+class StreamingPipeline( Pipeline ):
+    def __init__( self, args ):
+        super().__init__( args )
+        self.busy = {}
+
+
+    # take jobs from `inbox`, apply `stage` and pass them on to `outbox`
+    def worker( self, name, stage, batched, inbox, outbox ):
+        while True:
+            # batched stages also take the jobs which are already waiting, see `batchLimit`
+            jobs = [ inbox.get() ]
+            while batched and jobs[-1] is not STOP and len( jobs ) < self.batchLimit( name ):
+                try:
+                    jobs.append( inbox.get_nowait() )
+                except queue.Empty:
+                    break
+
+            stop = jobs[-1] is STOP
+            if stop:
+                jobs.pop()
+
+            if jobs:
+                start = time.perf_counter()
+                try:
+                    self.apply( name, stage, jobs, batched )
+                except Exception as e:
+                    logger.exception( f"Stage `{name}` failed on {', '.join( j.filename for j in jobs )}" )
+                    for job in jobs:
+                        job.error = e
+                self.busy[name] += time.perf_counter() - start
+
+                for job in jobs:
+                    outbox.put( job )
+
+            if stop:
+                outbox.put( STOP )
+                return
+
+
+    # queue every input path for the first stage
+    def feed( self, paths, outbox ):
+        for path in paths:
+            job = Job( path )
+            job.started = time.perf_counter()
+            outbox.put( job )
+        outbox.put( STOP )
+
+
+    # stream every input through the stages and return the finished jobs.
+    # videos are streamed chunk by chunk once the images are done
+    def runAll( self, paths, progress = None ):
+        videos = [ p for p in paths if isVideo( p ) ]
+        paths = [ p for p in paths if not isVideo( p ) ]
+        stages = self.stages()
+        queues = [ queue.Queue( maxsize = self.args.queue_size ) for _ in range( len( stages ) + 1 ) ]
+        self.busy = { name: 0.0 for name, _, _ in stages }
+
+        threads = [ threading.Thread( target = self.feed, args = ( paths, queues[0] ), daemon = True ) ]
+        for i, ( name, stage, batched ) in enumerate( stages ):
+            threads.append( threading.Thread( target = self.worker, name = name,
+                                              args = ( name, stage, batched, queues[i], queues[i + 1] ),
+                                              daemon = True ) )
+
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+
+        # collect finished jobs, their arrays are no longer needed
+        jobs = []
+        while True:
+            job = queues[-1].get()
+            if job is STOP:
+                break
+            job.latency = time.perf_counter() - job.started
+            job.release()
+            jobs.append( job )
+            if progress is not None:
+                progress.set_postfix( File = job.filename )
+                progress.update( 1 )
+
+        for t in threads:
+            t.join()
+
+        for path in videos:
+            jobs.append( self.runVideo( path ) )
+            if progress is not None:
+                progress.set_postfix( File = jobs[-1].filename )
+                progress.update( 1 )
+
+        self.report( jobs, time.perf_counter() - start )
+        return jobs
+
+
+    # log throughput and how busy each stage was
+    def report( self, jobs, elapsed ):
+        done = len( [ j for j in jobs if j.error is None and not j.skipped ] )
+        logger.info( f"Streamed {done}/{len(jobs)} images in {elapsed:.2f}s "
+                     f"({done / max(elapsed, 1e-9):.2f} images/s)" )
+        for name, busy in self.busy.items():
+            logger.info( f"Stage `{name}` busy {busy:.2f}s ({100 * busy / max(elapsed, 1e-9):.0f}%)" )
+        return
+
+
+# run inside a spawned worker process until the queue is exhausted. every worker
+# builds its own pipeline and models, and sends back what each input added to its counters
+def poolWorker( args, workerId, tasks, results ):
+    configureThreads( args.intra_op_threads, args.inter_op_threads )
+    pipeline = Pipeline( args )
+
+    # build the models before taking inputs, so that images only pay for inference
+    detect.getModel( pipeline.detectorConfig )
+    for style in args.styles:
+        cartoonize.get_model( style )
+
+    while True:
+        path = tasks.get()
+        if path is STOP:
+            break
+
+        start = time.perf_counter()
+        before = pipeline.counters()
+        error = None
+        try:
+            pipeline.run( path )
+        except Exception as e:
+            logger.exception( f"Worker {workerId} failed on {path}" )
+            error = repr( e )
+        stats = { k: v - before[k] for k, v in pipeline.counters().items() }
+        results.put( ( workerId, path, time.perf_counter() - start, error, stats ) )
+
+    results.put( ( workerId, STOP, 0.0, None, {} ) )
+
+
+# transforms inputs on worker processes pulling paths from a shared queue.
+# workers are spawned rather than forked, since the TensorFlow runtime is not fork-safe
+class ProcessPoolPipeline( Pipeline ):
+    # process every input on `args.num_workers` workers and return the finished jobs
+    def runAll( self, paths, progress = None ):
+        context = multiprocessing.get_context( 'spawn' )
+        tasks = context.Queue()
+        results = context.Queue()
+
+        # inputs finished by a previous run are skipped here, so the parent counts them
+        jobs = []
+        for path in paths:
+            job = Job( path )
+            if self.manifest is not None and not self.args.overwrite:
+                job.key = inputKey( path, self.args )
+                job.skipped = self.finished( job )
+            if job.skipped:
+                jobs.append( job )
+                if progress is not None:
+                    progress.update( 1 )
+            else:
+                tasks.put( path )
+
+        numWorkers = self.args.num_workers
+        for _ in range( numWorkers ):
+            tasks.put( STOP )
+
+        start = time.perf_counter()
+        workers = [ context.Process( target = poolWorker, args = ( self.args, i, tasks, results ) )
+                    for i in range( numWorkers ) ]
+        for w in workers:
+            w.start()
+
+        # collect results until every worker has finished
+        busy = [ 0.0 ] * numWorkers
+        counts = [ 0 ] * numWorkers
+        running = numWorkers
+        while running > 0:
+            workerId, path, latency, error, stats = results.get()
+            if path is STOP:
+                running -= 1
+                continue
+
+            self.mergeCounters( stats )
+            job = Job( path )
+            job.latency = latency
+            job.error = error
+            jobs.append( job )
+            busy[workerId] += latency
+            counts[workerId] += 1
+            if progress is not None:
+                progress.set_postfix( File = job.filename )
+                progress.update( 1 )
+
+        for w in workers:
+            w.join()
+
+        # workers wrote to the cache independently, enforce its budget over all of them
+        if self.cache is not None:
+            self.cache.reload()
+
+        self.report( jobs, counts, busy, time.perf_counter() - start )
+        return jobs
+
+
+    # log the throughput of each worker and of the whole pool. the rate per worker is measured
+    # while the workers compete for the machine, `benchmark.py pool_workers` compares against one worker
+    def report( self, jobs, counts, busy, elapsed ):
+        for i, ( count, seconds ) in enumerate( zip( counts, busy ) ):
+            logger.info( f"Worker {i}: {count} images in {seconds:.2f}s ({count / max(seconds, 1e-9):.2f} images/s)" )
+
+        done = len( [ j for j in jobs if j.error is None and not j.skipped ] )
+        aggregate = done / max( elapsed, 1e-9 )
+        perWorker = sum( counts ) / max( sum( busy ), 1e-9 )
+        logger.info( f"Processed {done}/{len(jobs)} images in {elapsed:.2f}s with {len(counts)} workers "
+                     f"({aggregate:.2f} images/s, {perWorker:.2f} images/s per busy worker)" )
+        return
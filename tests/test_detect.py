@@ -0,0 +1,41 @@
+import numpy as np
+
+import detect
+import enhance
+
+
+# optical flow moving every pixel of a height x width frame by ( dy, dx )
+def uniformFlow( height, width, dy, dx ):
+    flow = np.zeros( ( height, width, 2 ), np.float32 )
+    flow[..., 0] = dx
+    flow[..., 1] = dy
+    return flow
+
+
+def test_box_moved_off_frame_is_dropped():
+    objects = {
+        'rois': np.array( [ [ 10, 150, 50, 199 ], [ 10, 10, 50, 60 ] ] ),
+        'class_ids': np.array( [ 1, 3 ] ),
+        'scores': np.array( [ 0.99, 0.95 ] ),
+    }
+
+    # the first box leaves through the right edge and is clipped to zero width
+    moved = detect.propagateObjects( objects, uniformFlow( 100, 200, 0, 80 ) )
+
+    assert moved['rois'].tolist() == [ [ 10, 90, 50, 140 ] ]
+    assert moved['class_ids'].tolist() == [ 3 ]
+    assert moved['scores'].tolist() == [ 0.95 ]
+
+
+def test_empty_regions_are_skipped():
+    cartoon = np.random.RandomState( 0 ).randint( 0, 255, ( 100, 200, 3 ) ).astype( np.uint8 )
+    objects = {
+        'rois': np.array( [ [ 100, 10, 100, 50 ], [ 10, 200, 50, 200 ], [ 10, 10, 50, 60 ] ] ),
+        'scores': np.array( [ 0.99, 0.99, 0.99 ] ),
+    }
+
+    frame = enhance.FrameEdges( objects, cartoon, workers = 2 )
+    for method in enhance.EDGES:
+        edgeImage, enhancedImage = frame.enhance( method )
+        assert edgeImage.shape == cartoon.shape[:2]
+        assert not edgeImage[:, 60:].any()